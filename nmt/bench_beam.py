@@ -0,0 +1,181 @@
+'''
+Per-step microbenchmarks of the beam search in gen_sample
+
+f_init/f_next are replaced by stubs returning precomputed probabilities, so
+the timings only cover the host-side work done between two f_next calls:
+the hypothesis bookkeeping and the selection of the k best candidates.
+'''
+import argparse
+import time
+
+import numpy
+import copy
+
+from nmt import gen_sample, beam_prefilter, beam_select
+
+# stub sampler: every hypothesis stays alive (p(<eos>) = 0) so the beam is
+# full for all maxlen steps
+def fake_sampler(k, n_words, dim, n_pools=8, seed=1234):
+    rng = numpy.random.RandomState(seed)
+    pools = []
+    for ii in xrange(n_pools):
+        p = rng.rand(k, n_words).astype('float32')
+        p[:,0] = 0.
+        pools.append(p / p.sum(1, keepdims=True))
+    counter = [0]
+
+    def f_init(x, x_mask):
+        counter[0] = 0
+        ctx = numpy.zeros((x.shape[0], x.shape[1], 2 * dim)).astype('float32')
+        return [numpy.zeros((x.shape[1], dim)).astype('float32'), ctx, ctx + 0.]
+
+    def f_next(y, ctx, state, hyp_sents, ctx_mask, pctx):
+        counter[0] += 1
+        p = pools[counter[0] % n_pools][:y.shape[0]]
+        return [p, p.argmax(1), state + 0.]
+
+    return f_init, f_next
+
+# beam search with per-hypothesis python lists, as gen_sample used to do it
+def gen_sample_lists(f_init, f_next, x, k=1, maxlen=30):
+    sample = []
+    sample_score = []
+
+    live_k = 1
+    dead_k = 0
+
+    hyp_samples = [[]] * live_k
+    hyp_scores = numpy.zeros(live_k).astype('float32')
+
+    ret = f_init(x, numpy.ones(x.shape).astype('float32'))
+    next_state, ctx0, pctx = ret[0], ret[1], ret[2]
+    next_w = -1 * numpy.ones((1,)).astype('int64')
+
+    for ii in xrange(maxlen):
+        ctx = numpy.tile(ctx0.reshape((ctx0.shape[0],ctx0.shape[2])),
+                         [live_k, 1, 1]).transpose((1,0,2))
+        ret = f_next(next_w, ctx, next_state, numpy.zeros((live_k,)).astype('int64'),
+                     numpy.ones((ctx0.shape[0], live_k)).astype('float32'), pctx)
+        next_p, next_state = ret[0], ret[2]
+
+        cand_scores = hyp_scores[:,None] - numpy.log(next_p)
+        cand_flat = cand_scores.flatten()
+        ranks_flat = cand_flat.argsort(kind='mergesort')[:(k-dead_k)]
+
+        voc_size = next_p.shape[1]
+        trans_indices = ranks_flat / voc_size
+        word_indices = ranks_flat % voc_size
+        costs = cand_flat[ranks_flat]
+
+        new_hyp_samples = []
+        new_hyp_scores = numpy.zeros(k-dead_k).astype('float32')
+        new_hyp_states = []
+        for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
+            new_hyp_samples.append(hyp_samples[ti]+[wi])
+            new_hyp_scores[idx] = copy.copy(costs[idx])
+            new_hyp_states.append(copy.copy(next_state[ti]))
+
+        new_live_k = 0
+        hyp_samples = []
+        hyp_scores = []
+        hyp_states = []
+        for idx in xrange(len(new_hyp_samples)):
+            if new_hyp_samples[idx][-1] == 0:
+                sample.append(new_hyp_samples[idx])
+                sample_score.append(new_hyp_scores[idx])
+                dead_k += 1
+            else:
+                new_live_k += 1
+                hyp_samples.append(new_hyp_samples[idx])
+                hyp_scores.append(new_hyp_scores[idx])
+                hyp_states.append(new_hyp_states[idx])
+        hyp_scores = numpy.array(hyp_scores)
+        live_k = new_live_k
+
+        if new_live_k < 1 or dead_k >= k:
+            break
+
+        next_w = numpy.array([w[-1] for w in hyp_samples])
+        next_state = numpy.array(hyp_states)
+
+    for idx in xrange(live_k):
+        sample.append(hyp_samples[idx])
+        sample_score.append(hyp_scores[idx])
+
+    return sample, sample_score
+
+def bookkeeping_main(beams, n_words=1000, dim=1000, src_len=50, maxlen=100, n_repeats=3):
+    options = {'decoder': 'gru_cond'}
+    x = numpy.ones((src_len, 1)).astype('int64')
+
+    print 'k\tlists (ms/step)\tarrays (ms/step)\tspeedup'
+    for k in beams:
+        f_init, f_next = fake_sampler(k, n_words, dim)
+
+        t_lists = numpy.inf
+        t_arrays = numpy.inf
+        for rr in xrange(n_repeats):
+            start = time.time()
+            sample_l, score_l = gen_sample_lists(f_init, f_next, x, k=k, maxlen=maxlen)
+            t_lists = min(t_lists, time.time() - start)
+
+            start = time.time()
+            sample_a, score_a = gen_sample(None, f_init, f_next, x, options, k=k,
+                                           maxlen=maxlen, stochastic=False)
+            t_arrays = min(t_arrays, time.time() - start)
+
+        # ties are broken in (hypothesis, word) order by both
+        assert numpy.allclose(score_l, score_a)
+        assert [list(ss) for ss in sample_l] == [list(ss) for ss in sample_a]
+
+        print '%d\t%.3f\t\t%.3f\t\t\t%.2fx' % (k, 1000. * t_lists / maxlen,
+                                               1000. * t_arrays / maxlen, t_lists / t_arrays)
+
+def selection_main(beams, vocabs, n_repeats=10):
+    rng = numpy.random.RandomState(1234)
+
+    print 'k\t#words\targsort (ms/step)\tpartial (ms/step)\tspeedup'
+    for k in beams:
+        for n_words in vocabs:
+            cand_scores = rng.rand(k, n_words).astype('float32')
+
+            t_sort = numpy.inf
+            t_part = numpy.inf
+            for rr in xrange(n_repeats):
+                start = time.time()
+                ranks_flat = cand_scores.flatten().argsort(kind='mergesort')[:k]
+                t_sort = min(t_sort, time.time() - start)
+
+                start = time.time()
+                cand_words, cand_costs = beam_prefilter(cand_scores, k)
+                rows, words, costs = beam_select(cand_words, cand_costs, k)
+                t_part = min(t_part, time.time() - start)
+
+            assert (rows == ranks_flat / n_words).all()
+            assert (words == ranks_flat % n_words).all()
+
+            # many ties at the cut, which must go to the lower (hyp, word)
+            tied = numpy.floor(cand_scores * 4.)
+            ranks_flat = tied.flatten().argsort(kind='mergesort')[:k]
+            cand_words, cand_costs = beam_prefilter(tied, k)
+            rows, words, costs = beam_select(cand_words, cand_costs, k)
+            assert (rows == ranks_flat / n_words).all()
+            assert (words == ranks_flat % n_words).all()
+
+            print '%d\t%d\t%.3f\t\t\t%.3f\t\t\t%.1fx' % (k, n_words, 1000. * t_sort, 
+                                                         1000. * t_part, t_sort / t_part)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', type=int, nargs='+', default=[5, 12, 50])
+    parser.add_argument('-v', type=int, default=1000)
+    parser.add_argument('-d', type=int, default=1000)
+    parser.add_argument('-l', type=int, default=50)
+    parser.add_argument('-m', type=int, default=100)
+    parser.add_argument('--vocab', type=int, nargs='+', default=[1000, 10000, 30000, 100000])
+
+    args = parser.parse_args()
+
+    bookkeeping_main(args.k, n_words=args.v, dim=args.d, src_len=args.l, maxlen=args.m)
+    print
+    selection_main(args.k, args.vocab)
@@ -0,0 +1,81 @@
+'''
+Padding efficiency (real / padded tokens) of the batching schemes
+
+Only the length index is used: of a bitext given as source and target
+files (.h5 or compact .bin), or of synthetic log-normal lengths.
+'''
+import argparse
+import time
+
+import numpy
+
+from data_utils import split_batches, open_corpus
+
+def efficiency(batches, source_lengths, target_lengths):
+    real = 0
+    padded = 0
+    for idxs in batches:
+        for lengths in [source_lengths[idxs] + 1, target_lengths[idxs] + 1]:
+            real += lengths.sum()
+            padded += len(idxs) * lengths.max()
+    return real / float(padded)
+
+# HomogenousData: sorted within windows of k_batches minibatches
+def window_batches(order, source_lengths, target_lengths, batch_size, k_batches=10):
+    lengths = numpy.maximum(source_lengths, target_lengths)
+    batches = []
+    for ii in xrange(0, len(order), k_batches * batch_size):
+        chunk = order[ii:ii + k_batches * batch_size]
+        chunk = chunk[numpy.argsort(lengths[chunk], kind='mergesort')]
+        batches += split_batches(chunk, source_lengths, target_lengths, batch_size)
+    return batches
+
+def global_batches(order, source_lengths, target_lengths, batch_size, max_tokens=None):
+    lengths = numpy.maximum(source_lengths, target_lengths)
+    order = order[numpy.argsort(lengths[order], kind='mergesort')]
+    return split_batches(order, source_lengths, target_lengths, batch_size, max_tokens)
+
+def main(source_lengths, target_lengths, batch_size=80, max_len=50, max_tokens=None):
+    order = numpy.flatnonzero((source_lengths <= max_len) & (target_lengths <= max_len))
+    order = numpy.random.RandomState(1234).permutation(order)
+
+    schemes = [('file order', lambda: split_batches(order, source_lengths, target_lengths,
+                                                   batch_size)),
+               ('10-batch window', lambda: window_batches(order, source_lengths,
+                                                          target_lengths, batch_size)),
+               ('global sort', lambda: global_batches(order, source_lengths, target_lengths,
+                                                      batch_size))]
+    if max_tokens:
+        schemes.append(('global sort, %d tokens' % max_tokens,
+                        lambda: global_batches(order, source_lengths, target_lengths,
+                                               10 * batch_size, max_tokens)))
+
+    print '%d pairs' % len(order)
+    print 'scheme\t\t\t\t#batches\tefficiency\ttime (s)'
+    for name, fn in schemes:
+        start = time.time()
+        batches = fn()
+        tt = time.time() - start
+        print '%-24s\t%d\t\t%.3f\t\t%.2f' % (name, len(batches),
+                                            efficiency(batches, source_lengths, target_lengths), tt)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', type=int, default=80)
+    parser.add_argument('-l', type=int, default=50)
+    parser.add_argument('-t', type=int, default=None)
+    parser.add_argument('-n', type=int, default=1000000)
+    parser.add_argument('--source', type=str, default=None)
+    parser.add_argument('--target', type=str, default=None)
+
+    args = parser.parse_args()
+
+    if args.source:
+        source_lengths = open_corpus(args.source).lengths
+        target_lengths = open_corpus(args.target).lengths
+    else:
+        rng = numpy.random.RandomState(1234)
+        source_lengths = numpy.ceil(rng.lognormal(3., 0.6, size=args.n)).astype('int64')
+        target_lengths = numpy.ceil(source_lengths * rng.uniform(0.8, 1.3, size=args.n)).astype('int64')
+
+    main(source_lengths, target_lengths, batch_size=args.b, max_len=args.l, max_tokens=args.t)
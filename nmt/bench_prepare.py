@@ -0,0 +1,99 @@
+'''
+Host time of prepare_data per minibatch
+
+The vectorized prepare_data of data_utils, with and without a BufferPool, is
+compared against the per-sentence loop the dataset modules used to copy.
+'''
+import argparse
+import time
+
+import numpy
+
+from data_utils import prepare_data, BufferPool
+
+# the former per-sentence implementation
+def prepare_data_loop(seqs_x, seqs_y, maxlen=None, n_words_src=30000, n_words=30000):
+    lengths_x = [len(s) for s in seqs_x]
+    lengths_y = [len(s) for s in seqs_y]
+
+    if maxlen != None:
+        new_seqs_x = []
+        new_seqs_y = []
+        new_lengths_x = []
+        new_lengths_y = []
+        for l_x, s_x, l_y, s_y in zip(lengths_x, seqs_x, lengths_y, seqs_y):
+            if l_x < maxlen and l_y < maxlen:
+                new_seqs_x.append(s_x)
+                new_lengths_x.append(l_x)
+                new_seqs_y.append(s_y)
+                new_lengths_y.append(l_y)
+        lengths_x = new_lengths_x
+        seqs_x = new_seqs_x
+        lengths_y = new_lengths_y
+        seqs_y = new_seqs_y
+
+        if len(lengths_x) < 1 or len(lengths_y) < 1:
+            return None, None, None, None
+
+    n_samples = len(seqs_x)
+    maxlen_x = numpy.max(lengths_x) + 1
+    maxlen_y = numpy.max(lengths_y) + 1
+
+    x = numpy.zeros((maxlen_x, n_samples)).astype('int64')
+    y = numpy.zeros((maxlen_y, n_samples)).astype('int64')
+    x_mask = numpy.zeros((maxlen_x, n_samples)).astype('float32')
+    y_mask = numpy.zeros((maxlen_y, n_samples)).astype('float32')
+    for idx, [s_x, s_y] in enumerate(zip(seqs_x,seqs_y)):
+        s_x[numpy.where(s_x >= n_words_src-1)] = 1
+        s_y[numpy.where(s_y >= n_words-1)] = 1
+        x[:lengths_x[idx],idx] = s_x
+        x_mask[:lengths_x[idx]+1,idx] = 1.
+        y[:lengths_y[idx],idx] = s_y
+        y_mask[:lengths_y[idx]+1,idx] = 1.
+
+    return x, x_mask, y, y_mask
+
+def random_batch(rng, batch_size, max_len, vocab):
+    seqs_x = [rng.randint(2, vocab, size=rng.randint(1, max_len+1)) for ii in xrange(batch_size)]
+    seqs_y = [rng.randint(2, vocab, size=rng.randint(1, max_len+1)) for ii in xrange(batch_size)]
+    return seqs_x, seqs_y
+
+def main(batch_sizes, maxlen=50, max_len=60, vocab=40000, n_words=30000, n_batches=100):
+    rng = numpy.random.RandomState(1234)
+    pool = BufferPool()
+
+    print 'batch\tloop (ms)\tvectorized (ms)\tpooled (ms)\tspeedup'
+    for batch_size in batch_sizes:
+        batches = [random_batch(rng, batch_size, max_len, vocab) for ii in xrange(n_batches)]
+
+        for seqs_x, seqs_y in batches[:5]:
+            ref = prepare_data_loop([s.copy() for s in seqs_x], [s.copy() for s in seqs_y],
+                                    maxlen=maxlen, n_words_src=n_words, n_words=n_words)
+            for out in [prepare_data(seqs_x, seqs_y, maxlen=maxlen, n_words_src=n_words,
+                                     n_words=n_words),
+                        prepare_data(seqs_x, seqs_y, maxlen=maxlen, n_words_src=n_words,
+                                     n_words=n_words, pool=pool)]:
+                for aa, bb in zip(ref, out):
+                    assert aa.dtype == bb.dtype and (aa == bb).all()
+
+        timings = []
+        for fn, kwargs in [(prepare_data_loop, {}), (prepare_data, {}),
+                           (prepare_data, {'pool': pool})]:
+            start = time.time()
+            for seqs_x, seqs_y in batches:
+                fn(seqs_x, seqs_y, maxlen=maxlen, n_words_src=n_words, n_words=n_words, **kwargs)
+            timings.append(1000. * (time.time() - start) / n_batches)
+
+        print '%d\t%.3f\t\t%.3f\t\t%.3f\t\t%.1fx' % (batch_size, timings[0], timings[1],
+                                                     timings[2], timings[0] / timings[1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', type=int, nargs='+', default=[16, 64, 128, 256])
+    parser.add_argument('-m', type=int, default=50)
+    parser.add_argument('-l', type=int, default=60)
+    parser.add_argument('-n', type=int, default=100)
+
+    args = parser.parse_args()
+
+    main(args.b, maxlen=args.m, max_len=args.l, n_batches=args.n)
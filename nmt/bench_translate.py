@@ -0,0 +1,96 @@
+'''
+Throughput benchmark of translate.py job scheduling
+
+A randomly initialized model and a synthetic corpus with a wide spread of
+sentence lengths are written to a temporary directory and translated with
+one line per message in file order (the old scheme), with chunks of
+batch_size consecutive lines decoded as one minibatch, and with
+length-bucketed chunks. Timings include loading and compiling the sampler
+in every worker, so use enough sentences.
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+import cPickle as pkl
+
+from nmt import init_params
+import translate
+
+def make_model(path, dim_word, dim, n_words):
+    options = {'dim_word': dim_word, 'dim': dim, 'n_words': n_words, 'n_words_src': n_words,
+               'encoder': 'gru', 'decoder': 'gru_cond', 'hiero': None}
+    params = init_params(options)
+    numpy.savez(os.path.join(path, 'model.npz'), **params)
+    with open(os.path.join(path, 'model.npz.pkl'), 'wb') as f:
+        pkl.dump(options, f)
+
+    for name in ['src', 'trg']:
+        word_dict = dict(('%s%d' % (name, ii), ii) for ii in xrange(2, n_words))
+        with open(os.path.join(path, '%s.pkl' % name), 'wb') as f:
+            pkl.dump(word_dict, f)
+
+def make_corpus(fname, n_sents, n_words, min_len=3, max_len=80, seed=1234):
+    rng = numpy.random.RandomState(seed)
+    with open(fname, 'w') as f:
+        for ii in xrange(n_sents):
+            words = rng.randint(2, n_words, size=rng.randint(min_len, max_len+1))
+            print >>f, ' '.join('src%d' % ww for ww in words)
+
+def main(n_sents=200, n_process=4, batch_size=16, sort_window=20, k=5,
+         dim_word=128, dim=256, n_words=1000):
+    path = tempfile.mkdtemp()
+    try:
+        make_model(path, dim_word, dim, n_words)
+        source = os.path.join(path, 'source.txt')
+        make_corpus(source, n_sents, n_words)
+
+        # compile once beforehand, so that neither timing includes populating
+        # the theano cache
+        warmup = os.path.join(path, 'warmup.txt')
+        make_corpus(warmup, 1, n_words, max_len=3)
+        translate.main(os.path.join(path, 'model.npz'), os.path.join(path, 'src.pkl'),
+                       os.path.join(path, 'trg.pkl'), warmup, warmup + '.trans', k=k,
+                       n_process=1)
+
+        schemes = [('one line per message', 1, 1),
+                   ('file order chunks of %d' % batch_size, batch_size, 1),
+                   ('bucketed chunks of %d' % batch_size, batch_size, sort_window)]
+        outputs = []
+        timings = []
+        for name, bs, window in schemes:
+            saveto = os.path.join(path, 'trans.%d.txt' % len(outputs))
+            start = time.time()
+            translate.main(os.path.join(path, 'model.npz'), os.path.join(path, 'src.pkl'),
+                           os.path.join(path, 'trg.pkl'), source, saveto, k=k,
+                           n_process=n_process, batch_size=bs, sort_window=window)
+            timings.append(time.time() - start)
+            with open(saveto, 'r') as f:
+                outputs.append(f.read())
+
+        print
+        for (name, bs, window), tt, out in zip(schemes, timings, outputs):
+            # ties between equal scores can be broken differently in a batch
+            n_diff = sum(l0 != l1 for l0, l1 in zip(outputs[0].split('\n'), out.split('\n')))
+            print '%s: %.1fs, %.2f sentences/s, %.2fx, %d lines differ' % \
+                  (name, tt, n_sents / tt, timings[0] / tt, n_diff)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200)
+    parser.add_argument('-p', type=int, default=4)
+    parser.add_argument('-b', type=int, default=16)
+    parser.add_argument('-w', type=int, default=20)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('-d', type=int, default=256)
+    parser.add_argument('-v', type=int, default=1000)
+
+    args = parser.parse_args()
+
+    main(n_sents=args.n, n_process=args.p, batch_size=args.b, sort_window=args.w, k=args.k,
+         dim=args.d, n_words=args.v)
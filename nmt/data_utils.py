@@ -0,0 +1,280 @@
+'''
+Minibatch preparation shared by the dataset modules
+'''
+import numpy
+
+import time
+import threading
+import Queue
+
+# preallocated flat buffers handed out round-robin, so that the last n_slots
+# minibatches stay valid while a new one is built
+class BufferPool(object):
+    def __init__(self, n_slots=2):
+        self.slots = [dict() for ii in xrange(n_slots)]
+        self.cur = 0
+
+    def next_slot(self):
+        self.cur = (self.cur + 1) % len(self.slots)
+        return self.slots[self.cur]
+
+    def get(self, slot, name, shape, dtype):
+        size = shape[0] * shape[1]
+        if name not in slot or slot[name].size < size:
+            slot[name] = numpy.empty((size,), dtype=dtype)
+        return slot[name][:size].reshape(shape)
+
+# concatenate the sequences, clamp out-of-vocabulary ids to UNK (1) and
+# scatter them into a #words x #sentences matrix, followed by at least one
+# padding <eos> (0); the mask covers each sentence and its <eos>
+def pad_sequences(seqs, lengths, n_words, pool=None, slot=None, name='x'):
+    n_samples = len(seqs)
+    maxlen = lengths.max() + 1
+
+    if pool == None:
+        x = numpy.zeros((maxlen, n_samples), dtype='int64')
+        x_mask = numpy.empty((maxlen, n_samples), dtype='float32')
+    else:
+        x = pool.get(slot, name, (maxlen, n_samples), 'int64')
+        x_mask = pool.get(slot, name + '_mask', (maxlen, n_samples), 'float32')
+        x.fill(0)
+
+    if lengths.sum() > 0:
+        words = numpy.concatenate(seqs).astype('int64')
+        words = numpy.where(words >= n_words-1, 1, words)
+        offsets = numpy.cumsum(lengths) - lengths
+        cols = numpy.repeat(numpy.arange(n_samples), lengths)
+        rows = numpy.arange(words.shape[0]) - numpy.repeat(offsets, lengths)
+        x[rows, cols] = words
+    x_mask[:] = numpy.arange(maxlen)[:,None] <= lengths[None,:]
+
+    return x, x_mask
+
+# build padded source/target minibatches, dropping the pairs that are not
+# shorter than maxlen on both sides; with a BufferPool the returned arrays
+# are reused by later calls
+def prepare_data(seqs_x, seqs_y, maxlen=None, n_words_src=30000, n_words=30000, pool=None):
+    lengths_x = numpy.array([len(s) for s in seqs_x], dtype='int64')
+    lengths_y = numpy.array([len(s) for s in seqs_y], dtype='int64')
+
+    if maxlen != None:
+        keep = numpy.flatnonzero((lengths_x < maxlen) & (lengths_y < maxlen))
+        if keep.shape[0] < 1:
+            return None, None, None, None
+        if keep.shape[0] < lengths_x.shape[0]:
+            seqs_x = [seqs_x[ii] for ii in keep]
+            seqs_y = [seqs_y[ii] for ii in keep]
+            lengths_x = lengths_x[keep]
+            lengths_y = lengths_y[keep]
+
+    slot = None
+    if pool != None:
+        slot = pool.next_slot()
+    x, x_mask = pad_sequences(seqs_x, lengths_x, n_words_src, pool=pool, slot=slot, name='x')
+    y, y_mask = pad_sequences(seqs_y, lengths_y, n_words, pool=pool, slot=slot, name='y')
+
+    return x, x_mask, y, y_mask
+
+# cut a sequence of sentence indices into consecutive batches, of batch_size
+# sentences or, with max_tokens, as long as the padded source plus target
+# tokens (as laid out by prepare_data) stay within the budget
+def split_batches(order, source_lengths, target_lengths, batch_size, max_tokens=None):
+    if max_tokens == None:
+        return [order[ii:ii + batch_size] for ii in xrange(0, len(order), batch_size)]
+
+    batches = []
+    start = 0
+    max_x = max_y = 0
+    for ii, idx in enumerate(order):
+        max_x = max(max_x, source_lengths[idx] + 1)
+        max_y = max(max_y, target_lengths[idx] + 1)
+        n = ii - start + 1
+        if n > 1 and (n * (max_x + max_y) > max_tokens or n > batch_size):
+            batches.append(order[start:ii])
+            start = ii
+            max_x = source_lengths[idx] + 1
+            max_y = target_lengths[idx] + 1
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+# one side of a bitext, in the compact format (.bin) or as PyTables (.h5)
+def open_corpus(fname, table_name='/phrases', index_name='/indices', driver=None):
+    if fname.endswith('.bin'):
+        from mmap_dataset import MmapCorpus
+        return MmapCorpus(fname)
+    from tm_dataset import PytablesBitextStore
+    return PytablesBitextStore(fname, table_name, index_name, driver)
+
+# sentence indices of the successive batches, with the offset following the
+# last sentence of each, as PytablesBitextFetcher cuts them (also with a
+# max_tokens budget)
+def batch_schedule(source_lengths, target_lengths, batch_size, max_len, offset,
+                   use_infinite_loop=False, max_tokens=None):
+    valid = numpy.flatnonzero((source_lengths <= max_len) & (target_lengths <= max_len))
+    data_len = source_lengths.shape[0]
+    pos = numpy.searchsorted(valid, offset)
+    while True:
+        idxs = []
+        next_offset = offset
+        max_x = max_y = 0
+        while len(idxs) < batch_size:
+            if pos == len(valid):
+                if not use_infinite_loop or len(valid) == 0:
+                    next_offset = data_len
+                    break
+                pos = 0
+            if max_tokens:
+                idx = valid[pos]
+                len_x = source_lengths[idx] + 1
+                len_y = target_lengths[idx] + 1
+                if len(idxs) and (len(idxs) + 1) * (max(max_x, len_x) + max(max_y, len_y)) > max_tokens:
+                    break
+                idxs.append(idx)
+                max_x = max(max_x, len_x)
+                max_y = max(max_y, len_y)
+                next_offset = int(idx) + 1
+                pos += 1
+                continue
+            end = min(pos + batch_size - len(idxs), len(valid))
+            idxs.extend(valid[pos:end])
+            next_offset = int(valid[end - 1]) + 1
+            pos = end
+        if not idxs:
+            return
+        yield numpy.array(idxs), next_offset
+        if next_offset == data_len and not use_infinite_loop:
+            return
+
+# the sentences idxs, in that order, with one read per group of indices
+# less than max_gap apart instead of one per sentence
+def read_sentences(corpus, idxs, max_gap=32):
+    idxs = numpy.asarray(idxs)
+    sents = [None] * len(idxs)
+    if len(idxs) == 0:
+        return sents
+    order = numpy.argsort(idxs, kind='mergesort')
+    sorted_idxs = idxs[order]
+    cuts = numpy.flatnonzero(numpy.diff(sorted_idxs) > max_gap) + 1
+    for run in numpy.split(numpy.arange(len(idxs)), cuts):
+        start = sorted_idxs[run[0]]
+        chunk = corpus.read(start, sorted_idxs[run[-1]] + 1)
+        for ii in run:
+            sents[order[ii]] = chunk[sorted_idxs[ii] - start]
+    return sents
+
+# real / padded tokens of the minibatches seen so far
+class PaddingStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.real = 0
+        self.padded = 0
+
+    def update(self, seqs_x, seqs_y):
+        for seqs in [seqs_x, seqs_y]:
+            lengths = [len(s) + 1 for s in seqs]
+            self.real += sum(lengths)
+            self.padded += len(lengths) * max(lengths)
+
+    def efficiency(self):
+        return self.real / float(max(self.padded, 1))
+
+class BatchPrefetcher(object):
+    """
+    Wraps a training iterator and yields prepared (x, x_mask, y, y_mask)
+    minibatches. With n_ready > 0 a thread runs prepare_data on the next
+    batches while the current update runs and keeps up to n_ready of them;
+    with n_ready = 0, or prepare_data = None for iterators that already
+    prepare their batches, everything happens in next(). wait_time adds up
+    the time next() spent waiting for data, last_wait is that of the last
+    batch. get_state() is the state after the last batch returned, not
+    after those read ahead.
+    """
+    def __init__(self, iterator, prepare_data, n_ready=2, **kwargs):
+        self.iterator = iterator
+        self.prepare_data = prepare_data
+        self.n_ready = n_ready
+        self.kwargs = kwargs
+
+        self.thread = None
+        self.wait_time = 0.
+        self.last_wait = 0.
+        self.state = None
+
+    def prepare(self, batch):
+        if self.prepare_data == None:
+            return batch
+        return self.prepare_data(batch[0], batch[1], **self.kwargs)
+
+    def fill(self, queue, stop):
+        try:
+            for batch in self.iterator:
+                batch = (self.prepare(batch), self.iterator.get_state())
+                while not stop.is_set():
+                    try:
+                        queue.put(batch, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception, e:
+            queue.put(e)
+            return
+        queue.put(None)
+
+    def stop(self):
+        if self.thread == None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        self.state = self.iterator.get_state()
+        if self.n_ready > 0:
+            self.queue = Queue.Queue(maxsize=self.n_ready)
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self.fill, args=(self.queue, self.stop_event))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def start(self, start_offset=0):
+        self.stop()
+        self.iterator.start(start_offset)
+        self.run()
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.stop()
+        self.iterator.set_state(state)
+        self.run()
+
+    def close(self):
+        self.stop()
+        self.iterator.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        if self.thread == None:
+            batch = self.prepare(self.iterator.next())
+            self.state = self.iterator.get_state()
+        else:
+            item = self.queue.get()
+            if item == None:
+                self.thread = None
+                raise StopIteration
+            if isinstance(item, Exception):
+                self.thread = None
+                raise item
+            batch, self.state = item
+        self.last_wait = time.time() - start
+        self.wait_time += self.last_wait
+        return batch
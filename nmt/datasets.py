@@ -0,0 +1,133 @@
+'''
+Registry of the training corpora
+
+A dataset is a config: the binarized source and target files, the vocabulary
+sizes, the iterator and its batching, and how minibatches are prepared during
+training (loader processes and prefetched minibatches). The iterator module
+is only imported when a dataset is loaded.
+'''
+import functools
+import inspect
+
+import data_utils
+
+# iterators by name, as 'module.Class'; a config may also give the latter
+iterators = {'pytables': 'tm_dataset.PytablesBitextIterator',
+             'homogeneous': 'homogeneous_data.HomogenousData',
+             'bucketed': 'homogeneous_data.BucketedBitextIterator',
+             'mmap': 'mmap_dataset.MmapBitextIterator'}
+
+defaults = dict(source=None,            # binarized source side (.h5, or .bin with 'mmap')
+                target=None,            # binarized target side
+                dictionary_src=None,    # vocabularies, for translation and sampling
+                dictionary=None,
+                n_words_src=30000,      # vocabulary sizes assumed by prepare_data
+                n_words=30000,
+                iterator='homogeneous',
+                use_infinite_loop=False,
+                max_tokens=None,        # token budget per minibatch, None for batch_size sentences
+                n_loaders=0,            # loader processes, see ParallelBitextIterator
+                prefetch=2)             # minibatches prepared ahead by a thread
+
+configs = dict()
+
+def register(name, **config):
+    unknown = set(config) - set(defaults)
+    if unknown:
+        raise ValueError('Unknown dataset options: %s' % ', '.join(sorted(unknown)))
+    config = dict(defaults, **config)
+    if config['iterator'] not in iterators and '.' not in config['iterator']:
+        raise ValueError('Unknown iterator %s, known: %s' %
+                         (config['iterator'], ', '.join(sorted(iterators))))
+    if config['max_tokens'] != None and config['max_tokens'] <= 0:
+        raise ValueError('max_tokens must be positive, got %r' % config['max_tokens'])
+    if config['n_loaders'] < 0 or config['prefetch'] < 0:
+        raise ValueError('n_loaders and prefetch must not be negative')
+    configs[name] = config
+
+# only the target vocabularies of wmt14enfr and iwslt14zhen are known
+register('wmt14enfr',
+         source='/data/lisatmp3/chokyun/wmt14/parallel-corpus/en-fr/parallel.en.shuf.h5',
+         target='/data/lisatmp3/chokyun/wmt14/parallel-corpus/en-fr/parallel.fr.shuf.h5',
+         dictionary='/data/lisatmp3/chokyun/wmt14/parallel-corpus/en-fr/vocab.fr.pkl',
+         iterator='pytables')
+register('iwslt14zhen',
+         source='/data/lisatmp3/firatorh/nmt/zh-en_lm/trainedModels/union/binarized_text.zh.shuf.h5',
+         target='/data/lisatmp3/firatorh/nmt/zh-en_lm/trainedModels/union/binarized_text.en.shuf.h5',
+         dictionary='/data/lisatmp3/firatorh/nmt/zh-en_lm/trainedModels/unionFinetuneRnd/union_dict.pkl')
+register('openmt15zhen',
+         source='./openmt15/binarized_text.zh.shuf.h5',
+         target='./openmt15/binarized_text.en.shuf.h5',
+         dictionary_src='./openmt15/vocab.zh.pkl',
+         dictionary='./openmt15/vocab.en.pkl')
+register('stan',
+         source='./stan/vocab_and_data_sub_europarl/binarized_sub_europarl-v7.fr-en.en.h5',
+         target='./stan/vocab_and_data_sub_europarl/binarized_sub_europarl-v7.fr-en.fr.h5',
+         dictionary_src='./stan/vocab_and_data_sub_europarl/vocab_sub_europarl.en.pkl',
+         dictionary='./stan/vocab_and_data_sub_europarl/vocab_sub_europarl.fr.pkl')
+register('trans_enhi',
+         source='/data/lisatmp3/chokyun/transliteration/TranslitDataset/binarized_text.en.shuf.h5',
+         target='/data/lisatmp3/chokyun/transliteration/TranslitDataset/binarized_text.hi.shuf.h5',
+         dictionary_src='/data/lisatmp3/chokyun/transliteration/TranslitDataset/vocab.en.pkl',
+         dictionary='/data/lisatmp3/chokyun/transliteration/TranslitDataset/vocab.hi.pkl',
+         n_words_src=41, n_words=82, use_infinite_loop=True)
+
+def get_config(name):
+    if name not in configs:
+        raise KeyError('Unknown dataset %s, registered: %s' % (name, ', '.join(sorted(configs))))
+    return configs[name]
+
+def iterator_class(name):
+    module, cls = iterators.get(name, name).rsplit('.', 1)
+    return getattr(__import__(module), cls)
+
+# whether the constructor of cls takes name, also through the constructor
+# of a base class that it passes its keyword arguments to
+def takes_argument(cls, name):
+    for base in inspect.getmro(cls)[:-1]:
+        if '__init__' not in vars(base):
+            continue
+        spec = inspect.getargspec(base.__init__)
+        if name in spec.args:
+            return True
+        if spec.keywords == None:
+            return False
+    return False
+
+# the training iterator, with the batching of the config unless max_tokens
+# is given; there are no validation and test iterators. With n_loaders > 0
+# the iterator must also support ParallelBitextIterator.
+def load_data(name, batch_size=128, max_tokens=None, n_loaders=None):
+    config = get_config(name)
+    if max_tokens == None:
+        max_tokens = config['max_tokens']
+    if n_loaders == None:
+        n_loaders = config['n_loaders']
+
+    cls = iterator_class(config['iterator'])
+    kwargs = dict(use_infinite_loop=config['use_infinite_loop'])
+    if max_tokens != None:
+        if not takes_argument(cls, 'max_tokens'):
+            raise ValueError('%s does not support max_tokens' % cls.__name__)
+        kwargs['max_tokens'] = max_tokens
+    if n_loaders > 0:
+        from parallel_data import supported
+        if not supported(cls):
+            raise ValueError('%s does not support n_loaders > 0' % cls.__name__)
+
+    print '... initializing data iterators'
+
+    train = cls(batch_size, config['target'], config['source'], **kwargs)
+    valid = None
+    test = None
+
+    return train, valid, test
+
+# prepare_data defaulting to the vocabulary sizes of the dataset
+def prepare_data(name):
+    config = get_config(name)
+    return functools.partial(data_utils.prepare_data, n_words_src=config['n_words_src'],
+                             n_words=config['n_words'])
+
+def get_dataset(name):
+    return functools.partial(load_data, name), prepare_data(name)
@@ -4,6 +4,7 @@ import itertools
 import operator
 
 from tm_dataset import PytablesBitextIterator 
+from data_utils import split_batches, open_corpus, read_sentences, PaddingStats
 
 class HomogenousData(PytablesBitextIterator):
 
@@ -11,6 +12,49 @@ class HomogenousData(PytablesBitextIterator):
         PytablesBitextIterator.__init__(self, *args, **kwargs)
         self.batch_iter = None
 
+    def start(self, start_offset=0):
+        PytablesBitextIterator.start(self, start_offset)
+        self.batch_iter = None
+        self.window_offset = start_offset
+        self.window_pos = 0
+
+    # the batches of a window are rebuilt from its first offset, and those
+    # already returned are skipped
+    def get_state(self):
+        return {'offset': self.window_offset, 'skip': self.window_pos}
+
+    def set_state(self, state):
+        self.start(state['offset'])
+        for ii in xrange(state['skip']):
+            self.next()
+
+    # for ParallelBitextIterator: the windows of get_homogenous_batch_iter,
+    # built from the batches of PytablesBitextIterator
+    def start_state(self, start_offset, data_len, state=None):
+        state = PytablesBitextIterator.start_state(self, start_offset, data_len)
+        return {'offset': state['offset'], 'skip': 0}
+
+    def batch_schedule(self, source_lengths, target_lengths, state):
+        batches = PytablesBitextIterator.batch_schedule(self, source_lengths, target_lengths,
+                                                        {'offset': state['offset']})
+        window_offset = state['offset']
+        skip = state['skip']
+        while True:
+            window = list(itertools.islice(batches, 10))
+            if not window:
+                return
+            idxs = numpy.concatenate([ii for ii, ss in window])
+            lens = numpy.asarray([source_lengths[idxs], target_lengths[idxs]])
+            order = numpy.argsort(lens.max(axis=0))
+            for pos, indices in enumerate(split_batches(order, lens[0], lens[1],
+                                                        self.batch_size, self.max_tokens)):
+                if pos >= skip:
+                    yield idxs[indices], {'offset': window_offset, 'skip': pos + 1}
+            window_offset = window[-1][1]['offset']
+            skip = 0
+            if len(window) < 10:
+                return
+
     def get_homogenous_batch_iter(self):
         end_of_iter = False
         while True:
@@ -18,6 +62,8 @@ class HomogenousData(PytablesBitextIterator):
             batch_size = self.batch_size
             x = []
             y = []
+            self.window_offset = self.next_offset
+            self.window_pos = 0
             for k in xrange(k_batches):
                 try:
                     dx, dy = PytablesBitextIterator.next(self)
@@ -32,10 +78,8 @@ class HomogenousData(PytablesBitextIterator):
                 raise StopIteration
             lens = numpy.asarray([map(len, x), map(len, y)])
             order = numpy.argsort(lens.max(axis=0)) if k_batches > 1 else numpy.arange(len(x))
-            for k in range(k_batches):
-                if k * batch_size > len(order):
-                    break
-                indices = order[k * batch_size:(k + 1) * batch_size]
+            for indices in split_batches(order, lens[0], lens[1], batch_size, self.max_tokens):
+                self.window_pos += 1
                 yield [[x[ii] for ii in indices], [y[ii] for ii in indices]]
 
             if end_of_iter:
@@ -54,3 +98,126 @@ class HomogenousData(PytablesBitextIterator):
 
         return batch[0], batch[1]
 
+
+class BucketedBitextIterator(object):
+    """
+    Length-sorted batches over the whole length index instead of a window
+    of 10 minibatches. Each epoch the pairs are shuffled, sorted by length
+    within pools of sort_pool pairs (the whole corpus by default), cut into
+    batches of batch_size pairs or of at most max_tokens padded tokens, and
+    the batches are visited in random order.
+
+    next_offset counts the batches of the current epoch, start(offset)
+    resumes there. The sentences of a batch are read with one access per
+    group of nearby indices (read_sentences), the compact .bin format (or
+    can_fit for .h5) keeps the scattered reads cheap.
+    """
+    def __init__(self,
+                 batch_size,
+                 target_file=None,
+                 source_file=None,
+                 table_name='/phrases',
+                 index_name='/indices',
+                 can_fit=False,
+                 shuffle=True,
+                 use_infinite_loop=False,
+                 max_len=1000,
+                 sort_pool=None,
+                 max_tokens=None,
+                 seed=1234):
+
+        args = locals()
+        args.pop("self")
+        self.__dict__.update(args)
+
+        self.source, self.target = self.open_stores()
+        assert len(self.source) == len(self.target)
+        self.valid = numpy.flatnonzero((self.source.lengths <= max_len) &
+                                       (self.target.lengths <= max_len))
+        self.epoch = -1
+        self.stats = PaddingStats()
+
+    def open_stores(self):
+        driver = "H5FD_CORE" if self.can_fit else None
+        return (open_corpus(self.source_file, self.table_name, self.index_name, driver),
+                open_corpus(self.target_file, self.table_name, self.index_name, driver))
+
+    def get_batches(self, epoch):
+        lengths = numpy.maximum(self.source.lengths, self.target.lengths)
+        order = self.valid
+        rng = numpy.random.RandomState(self.seed + epoch)
+        if self.shuffle:
+            order = rng.permutation(order)
+        pool = self.sort_pool or len(order)
+        batches = []
+        for ii in xrange(0, len(order), pool):
+            chunk = order[ii:ii + pool]
+            chunk = chunk[numpy.argsort(lengths[chunk], kind='mergesort')]
+            batches += split_batches(chunk, self.source.lengths, self.target.lengths,
+                                     self.batch_size, self.max_tokens)
+        if self.shuffle:
+            batches = [batches[ii] for ii in rng.permutation(len(batches))]
+        return batches
+
+    def start(self, start_offset=0):
+        if start_offset <= 0 or self.epoch < 0:
+            self.epoch += 1
+        self.batches = self.get_batches(self.epoch)
+        self.next_offset = max(start_offset, 0)
+        self.stats.reset()
+
+    # position to resume from, saved with the checkpoints
+    def get_state(self):
+        return {'epoch': self.epoch, 'offset': self.next_offset, 'seed': self.seed}
+
+    def set_state(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.batches = self.get_batches(self.epoch)
+        self.next_offset = state['offset']
+        self.stats.reset()
+
+    # for ParallelBitextIterator; state is that of the last batch returned,
+    # which carries the epoch on with use_infinite_loop
+    def start_state(self, start_offset, data_len, state=None):
+        if state != None:
+            self.epoch = state['epoch']
+        if start_offset <= 0 or self.epoch < 0:
+            self.epoch += 1
+        return {'epoch': self.epoch, 'offset': max(start_offset, 0), 'seed': self.seed}
+
+    def batch_schedule(self, source_lengths, target_lengths, state):
+        self.seed = state['seed']
+        epoch = state['epoch']
+        offset = state['offset']
+        while True:
+            batches = self.get_batches(epoch)
+            for ii in xrange(offset, len(batches)):
+                yield batches[ii], {'epoch': epoch, 'offset': ii + 1, 'seed': self.seed}
+            if not self.use_infinite_loop:
+                return
+            epoch += 1
+            offset = 0
+
+    def close(self):
+        self.source.close()
+        self.target.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.next_offset == len(self.batches):
+            print 'Padding efficiency %.3f' % self.stats.efficiency()
+            if not self.use_infinite_loop:
+                raise StopIteration
+            self.stats.reset()
+            self.epoch += 1
+            self.batches = self.get_batches(self.epoch)
+            self.next_offset = 0
+        idxs = self.batches[self.next_offset]
+        self.next_offset += 1
+        x = read_sentences(self.source, idxs)
+        y = read_sentences(self.target, idxs)
+        self.stats.update(x, y)
+        return x, y
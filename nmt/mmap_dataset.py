@@ -0,0 +1,185 @@
+"""
+Compact binary corpus format and a zero-copy bitext iterator over it.
+
+A file holds one side of a bitext: a fixed-size header, the int64 sentence
+offsets (n_sents + 1 of them) and the concatenated tokens, stored as uint16
+when the vocabulary allows it and as uint32 otherwise. Both arrays are
+memory-mapped, sentences are views into the token array.
+
+Usage: python mmap_dataset.py corpus.h5 corpus.bin
+"""
+import argparse
+
+import numpy as np
+
+import logging
+
+from data_utils import batch_schedule
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'NMTCORP1'
+header_dtype = np.dtype([('magic', 'S8'), ('token_dtype', 'S8'),
+                         ('n_sents', '<i8'), ('n_tokens', '<i8')])
+
+def token_dtype(n_words):
+    if n_words <= np.iinfo(np.uint16).max + 1:
+        return np.dtype('<u2')
+    return np.dtype('<u4')
+
+# write a corpus given as an iterator over chunks of sentences
+def write_corpus(fname, chunks, n_sents, n_tokens, n_words):
+    dtype = token_dtype(n_words)
+    header = np.zeros((1,), dtype=header_dtype)
+    header['magic'] = MAGIC
+    header['token_dtype'] = dtype.str
+    header['n_sents'] = n_sents
+    header['n_tokens'] = n_tokens
+
+    offsets = np.memmap(fname, dtype='<i8', mode='w+', offset=header_dtype.itemsize,
+                        shape=(n_sents + 1,))
+    tokens = np.memmap(fname, dtype=dtype, mode='r+',
+                       offset=header_dtype.itemsize + offsets.nbytes, shape=(n_tokens,))
+    offsets[0] = 0
+    sidx = 0
+    tpos = 0
+    for sents in chunks:
+        lengths = np.array([len(ss) for ss in sents], dtype='int64')
+        offsets[sidx + 1:sidx + 1 + len(sents)] = tpos + np.cumsum(lengths)
+        if lengths.sum() > 0:
+            tokens[tpos:tpos + lengths.sum()] = np.concatenate(sents)
+        sidx += len(sents)
+        tpos += lengths.sum()
+    assert sidx == n_sents and tpos == n_tokens
+    offsets.flush()
+    tokens.flush()
+    del offsets, tokens
+
+    with open(fname, 'r+b') as f:
+        f.write(header.tobytes())
+
+# convert one side of a PyTables bitext (/phrases and /indices)
+def convert_table(source, saveto, table_name='/phrases', index_name='/indices', chunk_size=100000):
+    from tm_dataset import PytablesBitextStore
+
+    store = PytablesBitextStore(source, table_name, index_name)
+    n_sents = len(store)
+    n_tokens = int(store.lengths.sum())
+    n_words = 1
+    for ii in xrange(0, n_tokens, chunk_size * 10):
+        n_words = max(n_words, int(store.data[ii:ii + chunk_size * 10].max()) + 1)
+
+    chunks = (store.read(ii, min(ii + chunk_size, n_sents))
+              for ii in xrange(0, n_sents, chunk_size))
+    write_corpus(saveto, chunks, n_sents, n_tokens, n_words)
+    store.close()
+    logger.info("{}: {} sentences, {} tokens".format(saveto, n_sents, n_tokens))
+
+class MmapCorpus(object):
+    """
+    One side of a bitext in the compact format, mapped read-only.
+    """
+    def __init__(self, fname):
+        header = np.fromfile(fname, dtype=header_dtype, count=1)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError('%s is not a compact corpus file' % fname)
+        n_sents, n_tokens = int(header['n_sents']), int(header['n_tokens'])
+        # plain ndarray views of the maps, slicing a memmap object is slow
+        self.offsets = np.asarray(np.memmap(fname, dtype='<i8', mode='r',
+                                            offset=header_dtype.itemsize, shape=(n_sents + 1,)))
+        self.tokens = np.asarray(np.memmap(fname, dtype=np.dtype(header['token_dtype']), mode='r',
+                                           offset=header_dtype.itemsize + self.offsets.nbytes,
+                                           shape=(n_tokens,)))
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return self.lengths.shape[0]
+
+    def __getitem__(self, idx):
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
+
+    # same as PytablesBitextStore.read, the sentences stay views of the map
+    def read(self, start, end, dtype=None):
+        offsets = self.offsets[start:end + 1]
+        return [self.tokens[oo:ee] for oo, ee in zip(offsets[:-1], offsets[1:])]
+
+    def close(self):
+        pass
+
+class MmapBitextIterator(object):
+    """
+    Same interface as PytablesBitextIterator, max_tokens included. Sentence
+    pairs longer than max_len are excluded through the length index, and
+    batches are built synchronously since fetching a sentence is only a
+    slice of the map.
+    """
+    def __init__(self,
+                 batch_size,
+                 target_file=None,
+                 source_file=None,
+                 shuffle=True,
+                 use_infinite_loop=True,
+                 max_len=1000,
+                 max_tokens=None):
+
+        args = locals()
+        args.pop("self")
+        self.__dict__.update(args)
+
+        self.source = MmapCorpus(source_file)
+        self.target = MmapCorpus(target_file)
+        assert len(self.source) == len(self.target)
+        self.schedule = None
+
+    def start(self, start_offset=0):
+        state = self.start_state(start_offset, len(self.source))
+        self.schedule = self.batch_schedule(self.source.lengths, self.target.lengths, state)
+        self.next_offset = state['offset']
+
+    # position to resume from, saved with the checkpoints
+    def get_state(self):
+        return {'offset': self.next_offset}
+
+    def set_state(self, state):
+        self.start(state['offset'])
+
+    # for ParallelBitextIterator, see PytablesBitextIterator
+    def open_stores(self):
+        return MmapCorpus(self.source_file), MmapCorpus(self.target_file)
+
+    def start_state(self, start_offset, data_len, state=None):
+        offset = start_offset
+        if offset == -1:
+            offset = 0
+            if self.shuffle:
+                offset = np.random.randint(data_len)
+        return {'offset': offset}
+
+    def batch_schedule(self, source_lengths, target_lengths, state):
+        for idxs, next_offset in batch_schedule(source_lengths, target_lengths, self.batch_size,
+                                                self.max_len, state['offset'],
+                                                self.use_infinite_loop, self.max_tokens):
+            yield idxs, {'offset': next_offset}
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        idxs, state = next(self.schedule)
+        self.next_offset = state['offset']
+        return [self.source[ii] for ii in idxs], [self.target[ii] for ii in idxs]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table_name', type=str, default='/phrases')
+    parser.add_argument('--index_name', type=str, default='/indices')
+    parser.add_argument('source', type=str)
+    parser.add_argument('saveto', type=str)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    convert_table(args.source, args.saveto, table_name=args.table_name, index_name=args.index_name)
@@ -1,15 +1,25 @@
 '''
 Build a attention-based neural machine translation model
+
+Usage: python nmt.py old_model.npz model.npz, to convert a checkpoint to the
+fused GRU layout
 '''
+import argparse
+
 import theano
 import theano.tensor as tensor
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+from theano.compile.pfunc import rebuild_collect_shared
+from theano.scan_module.scan_op import Scan
 
 import cPickle as pkl
 import numpy
 import copy
 
 import os
+import re
+import shutil
+import hashlib
 import warnings
 import sys
 import time
@@ -18,25 +28,13 @@ from scipy import optimize, stats
 from collections import OrderedDict
 #from sklearn.cross_validation import KFold
 
-import wmt14enfr
-import iwslt14zhen
-import openmt15zhen
-import trans_enhi
-import stan
+import datasets
+from datasets import get_dataset
+from data_utils import BatchPrefetcher
+from vocab import Vocabulary
 
 profile = False
 
-# datasets: 'name', 'load_data: returns iterator', 'prepare_data: some preprocessing'
-datasets = {'wmt14enfr': (wmt14enfr.load_data, wmt14enfr.prepare_data),
-            'iwslt14zhen': (iwslt14zhen.load_data, iwslt14zhen.prepare_data),
-            'openmt15zhen': (openmt15zhen.load_data, openmt15zhen.prepare_data),
-            'trans_enhi': (trans_enhi.load_data, trans_enhi.prepare_data),
-            'stan': (stan.load_data, stan.prepare_data),
-            }
-
-def get_dataset(name):
-    return datasets[name][0], datasets[name][1]
-
 # push parameters to Theano shared variables
 def zipp(params, tparams):
     for kk, vv in params.iteritems():
@@ -53,6 +51,127 @@ def unzip(zipped):
 def itemlist(tparams):
     return [vv for kk, vv in tparams.iteritems()]
 
+# structure of an op for graph_key: its class and properties (the scalar op
+# of an Elemwise is one), the inner graph of a scan, or else its name
+def op_key(op):
+    cls = '%s.%s' % (type(op).__module__, type(op).__name__)
+    if isinstance(op, Scan):
+        return (cls, sorted(op.info.items()), graph_key(op.inputs, op.outputs))
+    if hasattr(op, '__props__'):
+        props = [getattr(op, pp) for pp in op.__props__]
+        return (cls, zip(op.__props__, [op_key(vv) if isinstance(vv, theano.gof.Op) else repr(vv)
+                                        for vv in props]))
+    return (cls, str(op))
+
+# the graph from inputs (and shared) to outputs, with the data of its
+# constants, as something repr can serialize entirely
+def graph_key(inputs, outputs, shared=[]):
+    ids = dict((vv, ('input', ii)) for ii, vv in enumerate(inputs))
+    ids.update((vv, ('shared', ii)) for ii, vv in enumerate(shared))
+    def var_key(vv):
+        if vv in ids:
+            return ids[vv]
+        if isinstance(vv, theano.Constant):
+            data = vv.data
+            if isinstance(data, numpy.ndarray):
+                data = (data.dtype.str, data.shape, hashlib.sha1(data.tostring()).hexdigest())
+            else:
+                data = repr(data)
+            return ('constant', str(vv.type), data)
+        return ('root', str(vv.type), vv.name)
+    nodes = []
+    for node in theano.gof.graph.io_toposort(list(inputs) + list(shared), outputs):
+        nodes.append((op_key(node.op), [var_key(vv) for vv in node.inputs],
+                      [str(vv.type) for vv in node.outputs]))
+        for ii, vv in enumerate(node.outputs):
+            ids[vv] = ('node', len(nodes) - 1, ii)
+    return nodes, [var_key(vv) for vv in outputs]
+
+# theano.function, reusing the optimized graph of an earlier run kept in
+# cache_dir, if given. The graph is stored without the values of its shared
+# variables (parameters, optimizer accumulators, random states); a loaded one
+# is linked to those of the current graph, so only linking is left to do. It
+# is looked up by the structure of the graph and the Theano version and
+# configuration.
+def compile_function(inputs, outputs, updates=None, name=None, cache_dir=None, **kwargs):
+    if cache_dir == None or kwargs.get('profile'):
+        return theano.function(inputs, outputs, updates=updates, name=name, **kwargs)
+
+    if isinstance(updates, dict):
+        updates = updates.items()
+    updates = list(updates or [])
+    outs = list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+    # the shared variables in the order theano.function appends them to the inputs
+    shared = rebuild_collect_shared(outs, inputs, updates=updates)[2][3]
+
+    graph = graph_key(inputs, outs + [vv for kk, vv in updates], shared)
+    # the configuration as printed, less the addresses of its type checkers
+    config = re.sub(' at 0x[0-9a-f]+', '', str(theano.config))
+    key = hashlib.sha1(repr([theano.__version__, numpy.__version__, config,
+                             [(vv.name, vv.type) for vv in inputs],
+                             [shared.index(kk) for kk, vv in updates],
+                             [(vv.name, vv.type) for vv in shared], sorted(kwargs.items()),
+                             isinstance(outputs, (list, tuple)), graph])).hexdigest()
+    fname = os.path.join(cache_dir, '%s-%s.pkl' % (name or 'function', key))
+
+    # graphs are pickled recursively
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 20000))
+
+    if os.path.exists(fname):
+        try:
+            with open(fname, 'rb') as f:
+                maker = pkl.load(f)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+        fn = maker.create([None] * len(inputs) + [sv.container for sv in shared])
+        fn.name = name
+        return fn
+
+    f = theano.function(inputs, outputs, updates=updates, name=name, **kwargs)
+    values = [sv.container.storage[0] for sv in shared]
+    try:
+        for sv in shared:
+            sv.container.storage[0] = numpy.zeros((1,) * sv.ndim, dtype=sv.dtype)
+        data = pkl.dumps(f.maker, protocol=pkl.HIGHEST_PROTOCOL)
+    except (RuntimeError, pkl.PicklingError, TypeError), e:
+        warnings.warn('%s not cached: %s' % (name, e))
+        return f
+    finally:
+        for sv, vv in zip(shared, values):
+            sv.container.storage[0] = vv
+        sys.setrecursionlimit(recursion_limit)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # written under a temporary name, workers may compile the same function
+    tmp = '%s.%d' % (fname, os.getpid())
+    with open(tmp, 'wb') as ff:
+        ff.write(data)
+    os.rename(tmp, fname)
+    return f
+
+# build(*args, **kwargs), e.g. compile_function or build_sampler, called on
+# first use; a Lazy of a function can be called like the function
+class Lazy(object):
+    def __init__(self, desc, build, *args, **kwargs):
+        self.desc = desc
+        self.build = build
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+
+    def get(self):
+        if self.value == None:
+            print 'Building %s...' % self.desc,
+            self.value = self.build(*self.args, **self.kwargs)
+            print 'Done'
+            self.build = self.args = self.kwargs = None
+        return self.value
+
+    def __call__(self, *args):
+        return self.get()(*args)
+
 # dropout
 def dropout_layer(state_before, use_noise, trng):
     proj = tensor.switch(use_noise, 
@@ -65,23 +184,113 @@ def _p(pp, name):
     return '%s_%s'%(pp, name)
 
 # initialize Theano shared variables according to the initial parameters
-def init_tparams(params):
+# borrow=True keeps the given arrays (e.g. read-only memory maps) without copy
+def init_tparams(params, borrow=False):
     tparams = OrderedDict()
     for kk, pp in params.iteritems():
-        tparams[kk] = theano.shared(params[kk], name=kk)
+        tparams[kk] = theano.shared(params[kk], name=kk, borrow=borrow)
     return tparams
 
-# load parameters
+# entries of the archives written by train besides the parameters, some of
+# them object arrays
+checkpoint_entries = ['zipped_params', 'history_errs', 'train_state',
+                      'train_err', 'valid_err', 'test_err']
+
+# the GRU layers keep the weights of the gates and of the candidate side by
+# side in one array; older checkpoints have the second part separately
+gru_fused = [('U', 'Ux'), ('U_nl', 'Ux_nl'), ('b_nl', 'bx_nl'), ('Wc', 'Wcx')]
+
+def unfused_name(kk):
+    for name, name_x in gru_fused:
+        if kk.endswith('_' + name):
+            return kk[:-len(name)] + name_x
+    return None
+
+# parameter kk of an archive, concatenated with its second part if the
+# archive has the unfused layout
+def fused_param(pp, kk):
+    kx = unfused_name(kk)
+    if kx == None or kx not in pp:
+        return pp[kk]
+    return numpy.concatenate([pp[kk], pp[kx]], axis=-1)
+
+# all arrays of an archive, in the fused layout
+def fuse_params(pp):
+    parts = [unfused_name(kk) for kk in pp.keys() if unfused_name(kk) in pp]
+    return dict((kk, fused_param(pp, kk)) for kk in pp.keys() if kk not in parts)
+
+# load parameters, either from a .npz archive or from a directory written by
+# unpack_params, whose arrays are memory-mapped read-only; checkpoints with
+# the unfused GRU layout are converted. A parameter missing from an archive
+# keeps its initial value, one missing from a directory is an error.
 def load_params(path, params):
-    pp = numpy.load(path)
+    if os.path.isdir(path):
+        pp = dict()
+        for kk in params.iterkeys():
+            for name in [kk, unfused_name(kk)]:
+                if name == None:
+                    continue
+                fname = os.path.join(path, '%s.npy'%name)
+                if os.path.exists(fname):
+                    pp[name] = numpy.load(fname, mmap_mode='r')
+    else:
+        pp = numpy.load(path)
     for kk, vv in params.iteritems():
         if kk not in pp:
+            if os.path.isdir(path):
+                raise IOError('%s is not in %s'%(kk, path))
             warnings.warn('%s is not in the archive'%kk)
             continue
-        params[kk] = pp[kk]
+        params[kk] = fused_param(pp, kk)
 
     return params
 
+# rewrite a checkpoint in the fused GRU layout; its other entries (the
+# pickled ones of a finished training included) are copied unchanged
+def convert_params(path, saveto):
+    numpy.savez(saveto, **fuse_params(numpy.load(path, allow_pickle=True)))
+
+# write the arrays of a .npz archive as uncompressed .npy files, in the fused
+# GRU layout, which processes can then memory-map and share through the page
+# cache
+def unpack_params(path, saveto=None):
+    if saveto == None:
+        saveto = '%s.mmap'%path
+    if os.path.isdir(saveto) and os.path.getmtime(saveto) >= os.path.getmtime(path):
+        return saveto
+
+    # written under a temporary name and moved into place once complete, so
+    # that an interrupted or concurrent run never leaves a partial directory
+    tmp = '%s.%d' % (saveto, os.getpid())
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    try:
+        archive = numpy.load(path)
+        pp = fuse_params(dict((kk, archive[kk]) for kk in archive.keys()
+                              if kk not in checkpoint_entries))
+        for kk, vv in pp.iteritems():
+            numpy.save(os.path.join(tmp, '%s.npy'%kk), vv)
+        os.utime(tmp, None)
+    except:
+        shutil.rmtree(tmp)
+        raise
+
+    if os.path.isdir(saveto):
+        # a stale copy; processes that map its arrays keep them
+        stale = '%s.stale.%d' % (saveto, os.getpid())
+        try:
+            os.rename(saveto, stale)
+            shutil.rmtree(stale)
+        except OSError:
+            pass
+    try:
+        os.rename(tmp, saveto)
+    except OSError:
+        # another process has just put its copy in place
+        shutil.rmtree(tmp)
+    return saveto
+
 # layers: 'name': ('parameter initializer', 'feedforward')
 layers = {'ff': ('param_init_fflayer', 'fflayer'),
           'ff_nb': ('param_init_fflayer_nb', 'fflayer_nb'),
@@ -510,14 +719,15 @@ def param_init_gru(options, params, prefix='gru', nin=None, dim=None, hiero=Fals
         params[_p(prefix,'b')] = numpy.zeros((2 * dim,)).astype('float32')
     U = numpy.concatenate([ortho_weight(dim),
                            ortho_weight(dim)], axis=1)
-    params[_p(prefix,'U')] = U
 
     Wx = norm_weight(nin, dim)
     params[_p(prefix,'Wx')] = Wx
     Ux = ortho_weight(dim)
-    params[_p(prefix,'Ux')] = Ux
     params[_p(prefix,'bx')] = numpy.zeros((dim,)).astype('float32')
 
+    # gates and candidate side by side, [U | Ux], one product per step
+    params[_p(prefix,'U')] = numpy.concatenate([U, Ux], axis=1)
+
     return params
 
 def param_init_gru_nonlin(options, params, prefix='gru', nin=None, dim=None, hiero=False):
@@ -532,23 +742,20 @@ def param_init_gru_nonlin(options, params, prefix='gru', nin=None, dim=None, hie
         params[_p(prefix,'b')] = numpy.zeros((2 * dim,)).astype('float32')
     U = numpy.concatenate([ortho_weight(dim),
                            ortho_weight(dim)], axis=1)
-    params[_p(prefix,'U')] = U
 
     Wx = norm_weight(nin, dim)
     params[_p(prefix,'Wx')] = Wx
     Ux = ortho_weight(dim)
-    params[_p(prefix,'Ux')] = Ux
     params[_p(prefix,'bx')] = numpy.zeros((dim,)).astype('float32')
 
+    params[_p(prefix,'U')] = numpy.concatenate([U, Ux], axis=1)
+
     
     U_nl = numpy.concatenate([ortho_weight(dim),
                               ortho_weight(dim)], axis=1)
-    params[_p(prefix,'U_nl')] = U_nl
-    params[_p(prefix,'b_nl')] = numpy.zeros((2 * dim,)).astype('float32')
-
     Ux_nl = ortho_weight(dim)
-    params[_p(prefix,'Ux_nl')] = Ux_nl
-    params[_p(prefix,'bx_nl')] = numpy.zeros((dim,)).astype('float32')
+    params[_p(prefix,'U_nl')] = numpy.concatenate([U_nl, Ux_nl], axis=1)
+    params[_p(prefix,'b_nl')] = numpy.zeros((3 * dim,)).astype('float32')
     
     return params
 
@@ -559,7 +766,7 @@ def gru_layer(tparams, state_below, options, prefix='gru', mask=None, **kwargs):
     else:
         n_samples = 1
 
-    dim = tparams[_p(prefix,'Ux')].shape[1]
+    dim = tparams[_p(prefix,'U')].shape[0]
 
     if mask == None:
         mask = tensor.alloc(1., state_below.shape[0], 1)
@@ -571,17 +778,16 @@ def gru_layer(tparams, state_below, options, prefix='gru', mask=None, **kwargs):
 
     state_below_ = tensor.dot(state_below, tparams[_p(prefix, 'W')]) + tparams[_p(prefix, 'b')]
     state_belowx = tensor.dot(state_below, tparams[_p(prefix, 'Wx')]) + tparams[_p(prefix, 'bx')]
-    U = tparams[_p(prefix, 'U')]
-    Ux = tparams[_p(prefix, 'Ux')]
 
-    def _step_slice(m_, x_, xx_, h_, U, Ux):
+    def _step_slice(m_, x_, xx_, h_, U):
+        # gates and candidate in one product
         preact = tensor.dot(h_, U)
-        preact += x_
+        preactg = preact[:, :2*dim] + x_
 
-        r = tensor.nnet.sigmoid(_slice(preact, 0, dim))
-        u = tensor.nnet.sigmoid(_slice(preact, 1, dim))
+        r = tensor.nnet.sigmoid(_slice(preactg, 0, dim))
+        u = tensor.nnet.sigmoid(_slice(preactg, 1, dim))
 
-        preactx = tensor.dot(h_, Ux)
+        preactx = _slice(preact, 2, dim)
         preactx = preactx * r
         preactx = preactx + xx_
 
@@ -599,8 +805,7 @@ def gru_layer(tparams, state_below, options, prefix='gru', mask=None, **kwargs):
                                 sequences=seqs,
                                 outputs_info = [tensor.alloc(0., n_samples, dim)],
                                                 #None, None, None, None],
-                                non_sequences = [tparams[_p(prefix, 'U')], 
-                                                 tparams[_p(prefix, 'Ux')]],
+                                non_sequences = [tparams[_p(prefix, 'U')]],
                                 name=_p(prefix, '_layers'),
                                 n_steps=nsteps,
                                 profile=profile,
@@ -621,12 +826,10 @@ def param_init_gru_cond_simple(options, params, prefix='gru_cond', nin=None, dim
     params = param_init_gru(options, params, prefix, nin=nin, dim=dim)
 
 
-    # context to LSTM
+    # context to LSTM, [Wc | Wcx]
     Wc = norm_weight(dimctx,dim*2)
-    params[_p(prefix,'Wc')] = Wc
-
     Wcx = norm_weight(dimctx,dim)
-    params[_p(prefix,'Wcx')] = Wcx
+    params[_p(prefix,'Wc')] = numpy.concatenate([Wc, Wcx], axis=1)
 
     return params
 
@@ -651,7 +854,7 @@ def gru_cond_simple_layer(tparams, state_below, options, prefix='gru',
     if mask == None:
         mask = tensor.alloc(1., state_below.shape[0], 1)
 
-    dim = tparams[_p(prefix, 'Ux')].shape[1]
+    dim = tparams[_p(prefix, 'U')].shape[0]
 
     # initial/previous state
     if init_state == None:
@@ -660,7 +863,8 @@ def gru_cond_simple_layer(tparams, state_below, options, prefix='gru',
     # projected context 
     assert context.ndim == 2, 'Context must be 2-d: #sample x dim'
     pctx_ = tensor.dot(context, tparams[_p(prefix,'Wc')])
-    pctxx_ = tensor.dot(context, tparams[_p(prefix,'Wcx')])
+    pctxx_ = pctx_[:, 2*dim:]
+    pctx_ = pctx_[:, :2*dim]
 
     def _slice(_x, n, dim):
         if _x.ndim == 3:
@@ -671,16 +875,16 @@ def gru_cond_simple_layer(tparams, state_below, options, prefix='gru',
     state_belowx = tensor.dot(state_below, tparams[_p(prefix, 'Wx')]) + tparams[_p(prefix, 'bx')]
     state_below_ = tensor.dot(state_below, tparams[_p(prefix, 'W')]) + tparams[_p(prefix, 'b')]
 
-    def _step_slice(m_, x_, xx_, h_, pctx_, pctxx_, U, Ux):
+    def _step_slice(m_, x_, xx_, h_, pctx_, pctxx_, U):
         preact = tensor.dot(h_, U)
-        preact += x_
-        preact += pctx_
-        preact = tensor.nnet.sigmoid(preact)
+        preactg = preact[:, :2*dim] + x_
+        preactg += pctx_
+        preactg = tensor.nnet.sigmoid(preactg)
 
-        r = _slice(preact, 0, dim)
-        u = _slice(preact, 1, dim)
+        r = _slice(preactg, 0, dim)
+        u = _slice(preactg, 1, dim)
 
-        preactx = tensor.dot(h_, Ux)
+        preactx = _slice(preact, 2, dim)
         preactx *= r
         preactx += xx_
         preactx += pctxx_
@@ -695,8 +899,7 @@ def gru_cond_simple_layer(tparams, state_below, options, prefix='gru',
     seqs = [mask, state_below_, state_belowx]
     _step = _step_slice
 
-    shared_vars = [tparams[_p(prefix, 'U')],
-                   tparams[_p(prefix, 'Ux')]] 
+    shared_vars = [tparams[_p(prefix, 'U')]]
 
     if one_step:
         rval = _step(*(seqs+[init_state, pctx_, pctxx_]+shared_vars))
@@ -723,12 +926,10 @@ def param_init_gru_cond(options, params, prefix='gru_cond', nin=None, dim=None,
 
     params = param_init_gru_nonlin(options, params, prefix, nin=nin, dim=dim)
 
-    # context to LSTM
+    # context to LSTM, [Wc | Wcx]
     Wc = norm_weight(dimctx,dim*2)
-    params[_p(prefix,'Wc')] = Wc
-
     Wcx = norm_weight(dimctx,dim)
-    params[_p(prefix,'Wcx')] = Wcx
+    params[_p(prefix,'Wc')] = numpy.concatenate([Wc, Wcx], axis=1)
     
     
 
@@ -755,7 +956,7 @@ def param_init_gru_cond(options, params, prefix='gru_cond', nin=None, dim=None,
 def gru_cond_layer(tparams, state_below, options, prefix='gru', 
                     mask=None, context=None, one_step=False, 
                     init_memory=None, init_state=None, 
-                    context_mask=None,
+                    context_mask=None, pctx=None,
                     **kwargs):
 
     assert context, 'Context must be provided'
@@ -773,15 +974,18 @@ def gru_cond_layer(tparams, state_below, options, prefix='gru',
     if mask == None:
         mask = tensor.alloc(1., state_below.shape[0], 1)
 
-    dim = tparams[_p(prefix, 'Wcx')].shape[1]
+    dim = tparams[_p(prefix, 'U')].shape[0]
 
     # initial/previous state
     if init_state == None:
         init_state = tensor.alloc(0., n_samples, dim)
 
-    # projected context 
+    # projected context, which the sampler computes once per sentence
     assert context.ndim == 3, 'Context must be 3-d: #annotation x #sample x dim'
-    pctx_ = tensor.dot(context, tparams[_p(prefix,'Wc_att')]) + tparams[_p(prefix,'b_att')]
+    if pctx == None:
+        pctx_ = tensor.dot(context, tparams[_p(prefix,'Wc_att')]) + tparams[_p(prefix,'b_att')]
+    else:
+        pctx_ = pctx
         
     def _slice(_x, n, dim):
         if _x.ndim == 3:
@@ -793,16 +997,18 @@ def gru_cond_layer(tparams, state_below, options, prefix='gru',
     state_below_ = tensor.dot(state_below, tparams[_p(prefix, 'W')]) + tparams[_p(prefix, 'b')]
     #state_belowc = tensor.dot(state_below, tparams[_p(prefix, 'Wi_att')])
     #import ipdb; ipdb.set_trace()
+    # U, U_nl, b_nl and Wc hold the gates and the candidate side by side,
+    # so that each product with the state or the context covers both
     def _step_slice(m_, x_, xx_, h_, ctx_, alpha_, pctx_, cc_,
-                    U, Wc, W_comb_att, U_att, c_tt, Ux, Wcx, U_nl, Ux_nl, b_nl, bx_nl):
+                    U, Wc, W_comb_att, U_att, c_tt, U_nl, b_nl):
         preact1 = tensor.dot(h_, U)
-        preact1 += x_
-        preact1 = tensor.nnet.sigmoid(preact1)
+        preactg1 = preact1[:, :2*dim] + x_
+        preactg1 = tensor.nnet.sigmoid(preactg1)
 
-        r1 = _slice(preact1, 0, dim)
-        u1 = _slice(preact1, 1, dim)
+        r1 = _slice(preactg1, 0, dim)
+        u1 = _slice(preactg1, 1, dim)
 
-        preactx1 = tensor.dot(h_, Ux)
+        preactx1 = _slice(preact1, 2, dim)
         preactx1 *= r1
         preactx1 += xx_
 
@@ -825,15 +1031,16 @@ def gru_cond_layer(tparams, state_below, options, prefix='gru',
         ctx_ = (cc_ * alpha[:,:,None]).sum(0) # current context
 
         preact2 = tensor.dot(h1, U_nl)+b_nl
-        preact2 += tensor.dot(ctx_, Wc)
-        preact2 = tensor.nnet.sigmoid(preact2)
+        preactc2 = tensor.dot(ctx_, Wc)
+        preactg2 = preact2[:, :2*dim] + preactc2[:, :2*dim]
+        preactg2 = tensor.nnet.sigmoid(preactg2)
 
-        r2 = _slice(preact2, 0, dim)
-        u2 = _slice(preact2, 1, dim)
+        r2 = _slice(preactg2, 0, dim)
+        u2 = _slice(preactg2, 1, dim)
 
-        preactx2 = tensor.dot(h1, Ux_nl)+bx_nl
+        preactx2 = _slice(preact2, 2, dim)
         preactx2 *= r2
-        preactx2 += tensor.dot(ctx_, Wcx)
+        preactx2 += _slice(preactc2, 2, dim)
 
         h2 = tensor.tanh(preactx2)
 
@@ -851,12 +1058,8 @@ def gru_cond_layer(tparams, state_below, options, prefix='gru',
                    tparams[_p(prefix,'W_comb_att')],
                    tparams[_p(prefix,'U_att')], 
                    tparams[_p(prefix, 'c_tt')], 
-                   tparams[_p(prefix, 'Ux')], 
-                   tparams[_p(prefix, 'Wcx')],
                    tparams[_p(prefix, 'U_nl')],
-                   tparams[_p(prefix, 'Ux_nl')],
-                   tparams[_p(prefix, 'b_nl')],
-                   tparams[_p(prefix, 'bx_nl')]]
+                   tparams[_p(prefix, 'b_nl')]]
 
     if one_step:
         rval = _step(*(seqs+[init_state, None, None, pctx_, context]+shared_vars))
@@ -947,7 +1150,7 @@ def gru_hiero_layer(tparams, context, options, prefix='gru_hiero',
         return _x[:, n*dim:(n+1)*dim]
 
     def _step_slice(m_, h_, ctx_, alpha_, v_, pp_, cc_,
-                    U, Wc, Wd_att, U_att, c_tt, Ux, Wx, bx, W_st, b_st):
+                    U, Wc, Wd_att, U_att, c_tt, Wx, bx, W_st, b_st):
         # attention
         pstate_ = tensor.dot(h_, Wd_att)
         pctx__ = pp_ + pstate_[None,:,:] 
@@ -961,13 +1164,13 @@ def gru_hiero_layer(tparams, context, options, prefix='gru_hiero',
         ctx = (cc_ * alpha[:,:,None]).sum(0) # current context
 
         preact = tensor.dot(h_, U)
-        preact += tensor.dot(ctx, Wc)
-        preact = tensor.nnet.sigmoid(preact)
+        preactg = preact[:, :2*dim] + tensor.dot(ctx, Wc)
+        preactg = tensor.nnet.sigmoid(preactg)
 
-        r = _slice(preact, 0, dim)
-        u = _slice(preact, 1, dim)
+        r = _slice(preactg, 0, dim)
+        u = _slice(preactg, 1, dim)
 
-        preactx = tensor.dot(h_, Ux)
+        preactx = _slice(preact, 2, dim)
         preactx = preactx * r
         preactx += tensor.dot(ctx, Wx)
         preactx += bx
@@ -1001,7 +1204,6 @@ def gru_hiero_layer(tparams, context, options, prefix='gru_hiero',
                                                tparams[_p(prefix,'Wd_att')], 
                                                tparams[_p(prefix,'U_att')], 
                                                tparams[_p(prefix, 'c_tt')], 
-                                               tparams[_p(prefix, 'Ux')], 
                                                tparams[_p(prefix, 'Wx')],
                                                tparams[_p(prefix, 'bx')], 
                                                tparams[_p(prefix, 'W_st')], 
@@ -1348,9 +1550,11 @@ def build_model(tparams, options):
     return trng, use_noise, x, x_mask, y, y_mask, opt_ret, cost
 
 # build a sampler
-def build_sampler(tparams, options, trng):
+def build_sampler(tparams, options, trng, shortlist=False, cache_dir=None):
     x = tensor.matrix('x', dtype='int64')
+    x_mask = tensor.matrix('x_mask', dtype='float32')
     xr = x[::-1]
+    xr_mask = x_mask[::-1]
     n_timesteps = x.shape[0]
     n_samples = x.shape[1]
 
@@ -1360,15 +1564,18 @@ def build_sampler(tparams, options, trng):
 
 
     # encoder
-    proj = get_layer(options['encoder'])[1](tparams, emb, options, prefix='encoder')
+    proj = get_layer(options['encoder'])[1](tparams, emb, options, prefix='encoder',
+                                            mask=x_mask)
     if options['decoder'].endswith('simple'):
         ctx = proj[0][-1]
         ctx_mean = ctx
     else:
-        projr = get_layer(options['encoder'])[1](tparams, embr, options, prefix='encoder_r')
+        projr = get_layer(options['encoder'])[1](tparams, embr, options, prefix='encoder_r',
+                                                 mask=xr_mask)
         ctx = concatenate([proj[0],projr[0][::-1]], axis=proj[0].ndim-1)
         if options['hiero']:
-            rval = get_layer(options['hiero'])[1](tparams, ctx, options, prefix='hiero')
+            rval = get_layer(options['hiero'])[1](tparams, ctx, options, prefix='hiero',
+                                                  context_mask=x_mask)
             ctx = rval[0]
         # initial state/cell
         # ctx_mean = ctx.mean(0)
@@ -1379,10 +1586,14 @@ def build_sampler(tparams, options, trng):
 
     print 'Building f_init...',
     outs = [init_state, ctx]
+    if options['decoder'] == 'gru_cond':
+        # attention keys do not change while decoding a sentence
+        pctx = tensor.dot(ctx, tparams['decoder_Wc_att']) + tparams['decoder_b_att']
+        outs += [pctx]
     if options['decoder'].startswith('lstm'):
         outs += [init_memory]
 
-    f_init = theano.function([x], outs, name='f_init', profile=profile)
+    f_init = compile_function([x, x_mask], outs, name='f_init', profile=profile, cache_dir=cache_dir)
     print 'Done'
 
     # x: 1 x 1
@@ -1393,6 +1604,23 @@ def build_sampler(tparams, options, trng):
         init_memory = tensor.matrix('init_memory', dtype='float32')
     else:
         init_memory = None
+    # f_next takes the encoder context of the whole batch as returned by
+    # f_init, hyp_sents gives the sentence each hypothesis belongs to
+    hyp_sents = tensor.vector('hyp_sents', dtype='int64')
+    # padded source positions must not receive attention when several
+    # sentences are decoded together
+    if options['decoder'].endswith('simple'):
+        ctx_mask = None
+        hyp_ctx = ctx[hyp_sents]
+        hyp_ctx_mask = None
+    else:
+        ctx_mask = tensor.matrix('ctx_mask', dtype='float32')
+        hyp_ctx = ctx.dimshuffle(1,0,2)[hyp_sents].dimshuffle(1,0,2)
+        hyp_ctx_mask = ctx_mask.T[hyp_sents].T
+    if options['decoder'] == 'gru_cond':
+        hyp_pctx = pctx.dimshuffle(1,0,2)[hyp_sents].dimshuffle(1,0,2)
+    else:
+        hyp_pctx = None
     
     n_timesteps = ctx.shape[0]
         
@@ -1404,13 +1632,15 @@ def build_sampler(tparams, options, trng):
 
     proj = get_layer(options['decoder'])[1](tparams, emb, options, 
                                             prefix='decoder', 
-                                            mask=None, context=ctx, 
+                                            mask=None, context=hyp_ctx, 
+                                            context_mask=hyp_ctx_mask,
+                                            pctx=hyp_pctx,
                                             one_step=True, 
                                             init_state=init_state,
                                             init_memory=init_memory)
     if options['decoder'].endswith('simple'):
         next_state = proj
-        ctxs = ctx
+        ctxs = hyp_ctx
     else:
         next_state = proj[0]
         ctxs = proj[1]
@@ -1424,60 +1654,74 @@ def build_sampler(tparams, options, trng):
     
     logit = tensor.tanh(logit_lstm+logit_prev+logit_ctx)
     
-    logit = get_layer('ff')[1](tparams, logit, options, prefix='ff_logit', activ='linear')
+    if shortlist:
+        # output layer restricted to a set of candidate target words, f_next
+        # then returns probabilities over these words only
+        words = tensor.vector('shortlist', dtype='int64')
+        logit = tensor.dot(logit, tparams['ff_logit_W'].T[words].T) + tparams['ff_logit_b'][words]
+    else:
+        logit = get_layer('ff')[1](tparams, logit, options, prefix='ff_logit', activ='linear')
     next_probs = tensor.nnet.softmax(logit)
     next_sample = trng.multinomial(pvals=next_probs).argmax(1)
+    if shortlist:
+        next_sample = words[next_sample]
 
     # next word probability
     print 'Building f_next..', 
-    inps = [y, ctx, init_state]
+    inps = [y, ctx, init_state, hyp_sents]
     outs = [next_probs, next_sample, next_state]
+    if ctx_mask is not None:
+        inps += [ctx_mask]
+    if hyp_pctx is not None:
+        inps += [pctx]
     if options['decoder'].startswith('lstm'):
         inps += [init_memory]
         outs += [next_memory]
+    if shortlist:
+        inps += [words]
     
-    f_next = theano.function(inps, outs, name='f_next', profile=profile)
+    f_next = compile_function(inps, outs, name='f_next', profile=profile, cache_dir=cache_dir)
     print 'Done'
 
     return f_init, f_next
 
 # generate sample
+# shortlist: sorted candidate target words, for a sampler built with shortlist=True
 def gen_sample(tparams, f_init, f_next, x, options, trng=None, k=1, maxlen=30, 
-               minlen=-1, stochastic=True, argmax=False):
+               minlen=-1, stochastic=True, argmax=False, shortlist=None):
     if k > 1:
         assert not stochastic, 'Beam search does not support stochastic sampling'
 
-    sample = []
-    sample_score = []
-    if stochastic:
-        sample_score = 0
+    x_mask = numpy.ones(x.shape).astype('float32')
+    if not stochastic:
+        sample, sample_score = gen_sample_batch(tparams, f_init, f_next, x, x_mask, options, 
+                                                trng=trng, k=k, maxlen=maxlen, minlen=minlen, 
+                                                shortlist=shortlist)
+        return sample[0], sample_score[0]
 
-    live_k = 1
-    dead_k = 0
+    sample = []
+    sample_score = 0
 
-    hyp_samples = [[]] * live_k
-    hyp_scores = numpy.zeros(live_k).astype('float32')
-    hyp_states = []
-    if options['decoder'].startswith('lstm'):
-        hyp_memories = []
-    
-    ret = f_init(x)
+    ret = f_init(x, x_mask)
     next_state = ret.pop(0)
-    ctx0 = ret.pop(0)
+    ctx = ret.pop(0)
+    if options['decoder'] == 'gru_cond':
+        pctx = ret.pop(0)
     if options['decoder'].startswith('lstm'):
         next_memory = ret.pop(0)
     
     next_w = -1 * numpy.ones((1,)).astype('int64')
 
     for ii in xrange(maxlen):
-        if options['decoder'].endswith('simple'):
-            ctx = numpy.tile(ctx0, [live_k, 1])
-        else:
-            ctx = numpy.tile(ctx0.reshape((ctx0.shape[0],ctx0.shape[2])), 
-                                          [live_k, 1, 1]).transpose((1,0,2))
-        inps = [next_w, ctx, next_state]
+        inps = [next_w, ctx, next_state, numpy.zeros((1,)).astype('int64')]
+        if not options['decoder'].endswith('simple'):
+            inps += [x_mask]
+        if options['decoder'] == 'gru_cond':
+            inps += [pctx]
         if options['decoder'].startswith('lstm'):
             inps += [next_memory]
+        if shortlist is not None:
+            inps += [shortlist]
         
         ret = f_next(*inps)
         next_p = ret.pop(0)
@@ -1486,79 +1730,182 @@ def gen_sample(tparams, f_init, f_next, x, options, trng=None, k=1, maxlen=30,
         if options['decoder'].startswith('lstm'):
             next_memory = ret.pop(0)
 
-        if stochastic:
-            if argmax:
-                nw = next_p[0].argmax()
-            else:
-                nw = next_w[0]
-            sample.append(nw)
+        if argmax:
+            nw = next_p[0].argmax()
             sample_score += next_p[0,nw]
-            if nw == 0:
-                break
+            if shortlist is not None:
+                nw = shortlist[nw]
         else:
-            cand_scores = hyp_scores[:,None] - numpy.log(next_p)
-            cand_flat = cand_scores.flatten()
-            ranks_flat = cand_flat.argsort()[:(k-dead_k)]
-            
-            voc_size = next_p.shape[1]
-            trans_indices = ranks_flat / voc_size
-            word_indices = ranks_flat % voc_size
-            costs = cand_flat[ranks_flat]
-
-            new_hyp_samples = []
-            new_hyp_scores = numpy.zeros(k-dead_k).astype('float32')
-            new_hyp_states = []
-            if options['decoder'].startswith('lstm'):
-                new_hyp_memories = []
-            
-            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                new_hyp_samples.append(hyp_samples[ti]+[wi])
-                new_hyp_scores[idx] = copy.copy(costs[idx])
-                new_hyp_states.append(copy.copy(next_state[ti]))
-                if options['decoder'].startswith('lstm'):
-                    new_hyp_memories.append(copy.copy(next_memory[ti]))
-
-            # check the finished samples
-            new_live_k = 0
-            hyp_samples = []
-            hyp_scores = []
-            hyp_states = []
-            if options['decoder'].startswith('lstm'):
-                hyp_memories = []
-
-            for idx in xrange(len(new_hyp_samples)):
-                if new_hyp_samples[idx][-1] == 0:
-                    if len(new_hyp_samples[idx]) >= minlen:
-                        sample.append(new_hyp_samples[idx])
-                        sample_score.append(new_hyp_scores[idx])
-                    dead_k += 1
-                else:
-                    new_live_k += 1
-                    hyp_samples.append(new_hyp_samples[idx])
-                    hyp_scores.append(new_hyp_scores[idx])
-                    hyp_states.append(new_hyp_states[idx])
-                    if options['decoder'].startswith('lstm'):
-                        hyp_memories.append(new_hyp_memories[idx])
-            hyp_scores = numpy.array(hyp_scores)
-            live_k = new_live_k
-
-            if new_live_k < 1:
-                break
-            if dead_k >= k:
-                break
-
-            next_w = numpy.array([w[-1] for w in hyp_samples])
-            next_state = numpy.array(hyp_states)
-            if options['decoder'].startswith('lstm'):
-                next_memory = numpy.array(hyp_memories)
+            nw = next_w[0]
+            if shortlist is not None:
+                sample_score += next_p[0,numpy.searchsorted(shortlist, nw)]
+            else:
+                sample_score += next_p[0,nw]
+        sample.append(nw)
+        if nw == 0:
+            break
 
-    if not stochastic:
-        # dump every remaining one
-        if live_k > 0:
-            for idx in xrange(live_k):
-                sample.append(hyp_samples[idx])
-                sample_score.append(hyp_scores[idx])
+    return sample, sample_score
+
+# candidate target words for shortlist decoding: <eos>, UNK, the n_frequent
+# most frequent words (the dictionaries are sorted by frequency) and the
+# translations of the source words given by lex_table (source id -> target
+# ids). x holds the source word ids of a sentence or of a whole batch.
+def build_shortlist(x, lex_table, n_frequent, n_words):
+    words = [numpy.arange(numpy.minimum(n_frequent, n_words))]
+    for ww in numpy.unique(x):
+        if ww in lex_table:
+            words.append(numpy.asarray(lex_table[ww], dtype='int64'))
+    words = numpy.unique(numpy.concatenate(words + [numpy.array([0, 1])]))
+    return words[words < n_words].astype('int64')
+
+# the n lowest values of each row of a 2-d array, as a boolean mask; values
+# tied with the n-th one are taken in increasing column order, as a stable
+# sort of the row would
+def lowest_mask(scores, n):
+    kth = numpy.partition(scores, n-1, axis=1)[:,n-1:n]
+    lower = scores < kth
+    ties = scores == kth
+    need = n - lower.sum(1)
+    return lower | (ties & (numpy.cumsum(ties, axis=1) <= need[:,None]))
+
+# keep the k best continuations of every hypothesis: no beam can take more
+# than k words from a single row, so the beams are searched among these
+# #hyps x k candidates, in increasing word order, instead of the #hyps x
+# #words scores
+def beam_prefilter(cand_scores, k):
+    n_hyps, voc_size = cand_scores.shape
+    if k < voc_size:
+        cand_words = numpy.nonzero(lowest_mask(cand_scores, k))[1].reshape(n_hyps, k)
+    else:
+        cand_words = numpy.tile(numpy.arange(voc_size), [n_hyps, 1])
+    cand_costs = cand_scores[numpy.arange(n_hyps)[:,None], cand_words]
+    return cand_words, cand_costs
+
+# select the n lowest cost candidates of a beam in increasing order of cost,
+# ties going to the lower (hypothesis, word) pair. This gives the same
+# ranking as the stable sort cand_scores.flatten().argsort(kind='mergesort')[:n]
+# without a full sort.
+def beam_select(cand_words, cand_costs, n):
+    n_cands = cand_words.shape[1]
+    cand_flat = cand_costs.flatten()
+    words_flat = cand_words.flatten()
+    if n < cand_flat.shape[0]:
+        # the candidates of a row are in increasing word order, so flat
+        # positions are in (hypothesis, word) order
+        ranks_flat = numpy.flatnonzero(lowest_mask(cand_flat[None,:], n)[0])
+    else:
+        ranks_flat = numpy.arange(cand_flat.shape[0])
+    ranks_flat = ranks_flat[numpy.argsort(cand_flat[ranks_flat], kind='mergesort')]
 
+    return ranks_flat / n_cands, words_flat[ranks_flat], cand_flat[ranks_flat]
+
+# generate samples for a minibatch of source sentences with beam search
+# x, x_mask: #words x #sentences, padded the same way as prepare_data does
+def gen_sample_batch(tparams, f_init, f_next, x, x_mask, options, trng=None, k=1, 
+                     maxlen=30, minlen=-1, shortlist=None):
+    n_sents = x.shape[1]
+
+    sample = [[] for _ in xrange(n_sents)]
+    sample_score = [[] for _ in xrange(n_sents)]
+    dead_k = numpy.zeros(n_sents).astype('int64')
+
+    ret = f_init(x, x_mask)
+    next_state = ret.pop(0)
+    ctx = ret.pop(0)
+    if options['decoder'] == 'gru_cond':
+        pctx = ret.pop(0)
+    if options['decoder'].startswith('lstm'):
+        next_memory = ret.pop(0)
+
+    # live hypotheses of all sentences are stacked along the sample axis and
+    # hyp_sents tells which sentence each of them belongs to. The beam history
+    # is kept in preallocated arrays: after step ii, column jj of hyp_words[ii]
+    # holds the word emitted by the jj-th live hypothesis and hyp_prevs[ii] the
+    # column at step ii-1 it extends.
+    hyp_words = numpy.zeros((maxlen, n_sents * k)).astype('int64')
+    hyp_prevs = numpy.zeros((maxlen, n_sents * k)).astype('int64')
+    hyp_sents = numpy.arange(n_sents)
+    hyp_scores = numpy.zeros(n_sents).astype('float32')
+
+    def _backtrack(ii, jj):
+        seq = []
+        for tt in xrange(ii, -1, -1):
+            seq.append(hyp_words[tt, jj])
+            jj = hyp_prevs[tt, jj]
+        return seq[::-1]
+
+    next_w = -1 * numpy.ones((n_sents,)).astype('int64')
+
+    # with maxlen = 0 every sentence gets an empty sample
+    ii = -1
+    for ii in xrange(maxlen):
+        inps = [next_w, ctx, next_state, hyp_sents]
+        if not options['decoder'].endswith('simple'):
+            inps += [x_mask]
+        if options['decoder'] == 'gru_cond':
+            inps += [pctx]
+        if options['decoder'].startswith('lstm'):
+            inps += [next_memory]
+        if shortlist is not None:
+            inps += [shortlist]
+
+        ret = f_next(*inps)
+        next_p = ret.pop(0)
+        next_w = ret.pop(0)
+        next_state = ret.pop(0)
+        if options['decoder'].startswith('lstm'):
+            next_memory = ret.pop(0)
+
+        cand_scores = hyp_scores[:,None] - numpy.log(next_p)
+        cand_words, cand_costs = beam_prefilter(cand_scores, k)
+
+        # hypotheses of a sentence are contiguous, so the beams can be
+        # searched sentence by sentence
+        starts = numpy.flatnonzero(numpy.r_[True, hyp_sents[1:] != hyp_sents[:-1]])
+        ends = numpy.r_[starts[1:], len(hyp_sents)]
+        trans_indices = []
+        word_indices = []
+        costs = []
+        for start, end in zip(starts, ends):
+            rows, words, cc = beam_select(cand_words[start:end], cand_costs[start:end], 
+                                          k-dead_k[hyp_sents[start]])
+            trans_indices.append(start + rows)
+            word_indices.append(words)
+            costs.append(cc)
+        trans_indices = numpy.concatenate(trans_indices)
+        word_indices = numpy.concatenate(word_indices)
+        if shortlist is not None:
+            word_indices = shortlist[word_indices]
+        costs = numpy.concatenate(costs)
+        new_sents = hyp_sents[trans_indices]
+
+        # check the finished samples
+        dead = word_indices == 0
+        if ii + 1 >= minlen:
+            for jj in numpy.flatnonzero(dead):
+                sample[new_sents[jj]].append(_backtrack(ii-1, trans_indices[jj]) + [0])
+                sample_score[new_sents[jj]].append(costs[jj])
+        dead_k += numpy.bincount(new_sents[dead], minlength=n_sents)
+
+        live = numpy.flatnonzero(~dead)
+        hyp_words[ii,:len(live)] = word_indices[live]
+        hyp_prevs[ii,:len(live)] = trans_indices[live]
+        hyp_sents = new_sents[live]
+        hyp_scores = costs[live]
+
+        if len(live) < 1:
+            break
+
+        next_w = word_indices[live]
+        next_state = next_state[trans_indices[live]]
+        if options['decoder'].startswith('lstm'):
+            next_memory = next_memory[trans_indices[live]]
+
+    # dump every remaining one
+    for jj in xrange(len(hyp_sents)):
+        sample[hyp_sents[jj]].append(_backtrack(ii, jj))
+        sample_score[hyp_sents[jj]].append(hyp_scores[jj])
 
     return sample, sample_score
 
@@ -1573,7 +1920,7 @@ def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True):
 
         x, x_mask, y, y_mask = prepare_data(x, y, maxlen=50, n_words_src=options['n_words_src'], n_words=options['n_words'])
         
-        if x == None:
+        if x is None:
             continue
 
         pprobs = f_log_probs(x,x_mask,y,y_mask)
@@ -1587,11 +1934,11 @@ def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True):
 
 # optimizers
 # name(hyperp, tparams, grads, inputs (list), cost) = f_grad_shared, f_update
-def adam(lr, tparams, grads, inp, cost):
+def adam(lr, tparams, grads, inp, cost, cache_dir=None):
     gshared = [theano.shared(p.get_value() * 0., name='%s_grad'%k) for k, p in tparams.iteritems()]
     gsup = [(gs, g) for gs, g in zip(gshared, grads)]
 
-    f_grad_shared = theano.function(inp, cost, updates=gsup, profile=profile)
+    f_grad_shared = compile_function(inp, cost, updates=gsup, name='f_grad_shared', profile=profile, cache_dir=cache_dir)
 
     lr0 = 0.0002
     b1 = 0.1
@@ -1618,11 +1965,11 @@ def adam(lr, tparams, grads, inp, cost):
         updates.append((p, p_t))
     updates.append((i, i_t))
 
-    f_update = theano.function([lr], [], updates=updates, on_unused_input='ignore', profile=profile)
+    f_update = compile_function([lr], [], updates=updates, on_unused_input='ignore', name='f_update', profile=profile, cache_dir=cache_dir)
 
     return f_grad_shared, f_update
 
-def adadelta(lr, tparams, grads, inp, cost):
+def adadelta(lr, tparams, grads, inp, cost, cache_dir=None):
     running_up2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rup2'%k) for k, p in tparams.iteritems()]
     running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2'%k) for k, p in tparams.iteritems()]
 
@@ -1634,12 +1981,12 @@ def adadelta(lr, tparams, grads, inp, cost):
     ru2up = [(ru2, 0.95 * ru2 + 0.05 * (ud ** 2)) for ru2, ud in zip(running_up2, updir)]
     param_up = [(p, p + ud) for p, ud in zip(itemlist(tparams), updir)]
 
-    inp += [lr]
-    f_update = theano.function(inp, cost, updates=rg2up+ru2up+param_up, on_unused_input='ignore', profile=profile)
+    inp = inp + [lr]
+    f_update = compile_function(inp, cost, updates=rg2up+ru2up+param_up, on_unused_input='ignore', name='f_update', profile=profile, cache_dir=cache_dir)
 
     return f_update
 
-def debugging_adadelta(lr, tparams, grads, inp, cost):
+def debugging_adadelta(lr, tparams, grads, inp, cost, cache_dir=None):
     zipped_grads = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_grad'%k) for k, p in tparams.iteritems()]
     running_up2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rup2'%k) for k, p in tparams.iteritems()]
     running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2'%k) for k, p in tparams.iteritems()]
@@ -1647,18 +1994,18 @@ def debugging_adadelta(lr, tparams, grads, inp, cost):
     zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
     rg2up = [(rg2, 0.95 * rg2 + 0.05 * (g ** 2)) for rg2, g in zip(running_grads2, grads)]
 
-    f_grad_shared = theano.function(inp, cost, updates=zgup+rg2up, profile=profile)
+    f_grad_shared = compile_function(inp, cost, updates=zgup+rg2up, name='f_grad_shared', profile=profile, cache_dir=cache_dir)
     
     
     updir = [-tensor.sqrt(ru2 + 1e-6) / tensor.sqrt(rg2 + 1e-6) * zg for zg, ru2, rg2 in zip(zipped_grads, running_up2, running_grads2)]
     ru2up = [(ru2, 0.95 * ru2 + 0.05 * (ud ** 2)) for ru2, ud in zip(running_up2, updir)]
     param_up = [(p, p + ud) for p, ud in zip(itemlist(tparams), updir)]
 
-    f_update = theano.function([lr], [], updates=ru2up+param_up, on_unused_input='ignore', profile=profile)
+    f_update = compile_function([lr], [], updates=ru2up+param_up, on_unused_input='ignore', name='f_update', profile=profile, cache_dir=cache_dir)
 
     return f_grad_shared, f_update
 
-def rmsprop(lr, tparams, grads, inp, cost):
+def rmsprop(lr, tparams, grads, inp, cost, cache_dir=None):
     zipped_grads = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_grad'%k) for k, p in tparams.iteritems()]
     running_grads = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad'%k) for k, p in tparams.iteritems()]
     running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2'%k) for k, p in tparams.iteritems()]
@@ -1667,23 +2014,23 @@ def rmsprop(lr, tparams, grads, inp, cost):
     rgup = [(rg, 0.95 * rg + 0.05 * g) for rg, g in zip(running_grads, grads)]
     rg2up = [(rg2, 0.95 * rg2 + 0.05 * (g ** 2)) for rg2, g in zip(running_grads2, grads)]
 
-    f_grad_shared = theano.function(inp, cost, updates=zgup+rgup+rg2up, profile=profile)
+    f_grad_shared = compile_function(inp, cost, updates=zgup+rgup+rg2up, name='f_grad_shared', profile=profile, cache_dir=cache_dir)
 
     updir = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_updir'%k) for k, p in tparams.iteritems()]
     updir_new = [(ud, 0.9 * ud - 1e-4 * zg / tensor.sqrt(rg2 - rg ** 2 + 1e-4)) for ud, zg, rg, rg2 in zip(updir, zipped_grads, running_grads, running_grads2)]
     param_up = [(p, p + udn[1]) for p, udn in zip(itemlist(tparams), updir_new)]
-    f_update = theano.function([lr], [], updates=updir_new+param_up, on_unused_input='ignore', profile=profile)
+    f_update = compile_function([lr], [], updates=updir_new+param_up, on_unused_input='ignore', name='f_update', profile=profile, cache_dir=cache_dir)
 
     return f_grad_shared, f_update
 
-def sgd(lr, tparams, grads, x, mask, y, cost):
+def sgd(lr, tparams, grads, x, mask, y, cost, cache_dir=None):
     gshared = [theano.shared(p.get_value() * 0., name='%s_grad'%k) for k, p in tparams.iteritems()]
     gsup = [(gs, g) for gs, g in zip(gshared, grads)]
 
-    f_grad_shared = theano.function([x, mask, y], cost, updates=gsup, profile=profile)
+    f_grad_shared = compile_function([x, mask, y], cost, updates=gsup, name='f_grad_shared', profile=profile, cache_dir=cache_dir)
 
     pup = [(p, p - lr * g) for p, g in zip(itemlist(tparams), gshared)]
-    f_update = theano.function([lr], [], updates=pup, profile=profile)
+    f_update = compile_function([lr], [], updates=pup, name='f_update', profile=profile, cache_dir=cache_dir)
 
     return f_grad_shared, f_update
 
@@ -1711,29 +2058,39 @@ def train(dim_word=100, # word vector dimensionality
           saveFreq=1000, # save the parameters after every saveFreq updates
           sampleFreq=100, # generate some samples after every sampleFreq updates
           dataset='wmt14enfr',
-          dictionary=None, # word dictionary
+          dictionary=None, # word dictionary, None for the one of the dataset
           dictionary_src=None, # word dictionary
           use_dropout=False,
           reload_=False,
           correlation_coeff=0.1,
-          clip_c=0.):
-
-    # Model options
+          clip_c=0.,
+          n_loaders=None, # processes preparing minibatches, 0 for the fetcher thread
+          max_tokens=None, # cut minibatches at this many padded source+target tokens
+          prefetch=None, # minibatches prepared ahead by a thread, 0 to prepare them in the loop
+          cache_dir=None, # keep the compiled functions there for the next runs
+          lazy_compile=True): # build the sampler and validation functions when first needed
+
+    # settings left to None are those of the dataset
+    config = datasets.get_config(dataset)
+    if dictionary == None:
+        dictionary = config['dictionary']
+    if dictionary_src == None:
+        dictionary_src = config['dictionary_src']
+    if n_loaders == None:
+        n_loaders = config['n_loaders']
+    if prefetch == None:
+        prefetch = config['prefetch']
+    del config
+
+    # Model options, without where this run keeps its compiled functions
     model_options = locals().copy()
+    del model_options['cache_dir']
     
     if dictionary:
-        with open(dictionary, 'rb') as f:
-            word_dict = pkl.load(f)
-        word_idict = dict()
-        for kk, vv in word_dict.iteritems():
-            word_idict[vv] = kk
+        vocab = Vocabulary.load(dictionary)
 
     if dictionary_src:
-        with open(dictionary_src, 'rb') as f:
-            word_dict_src = pkl.load(f)
-        word_idict_src = dict()
-        for kk, vv in word_dict_src.iteritems():
-            word_idict_src[vv] = kk
+        vocab_src = Vocabulary.load(dictionary_src)
 
     # reload options
     if reload_ and os.path.exists(saveto):
@@ -1742,7 +2099,17 @@ def train(dim_word=100, # word vector dimensionality
     #import ipdb; ipdb.set_trace()
     print 'Loading data'
     load_data, prepare_data = get_dataset(dataset)
-    train, valid, test = load_data(batch_size=batch_size)
+    train, valid, test = load_data(batch_size=batch_size, max_tokens=max_tokens,
+                                   n_loaders=n_loaders)
+    if n_loaders > 0:
+        from parallel_data import ParallelBitextIterator
+        # the shared buffers of the batches must not be read ahead
+        train = ParallelBitextIterator(train, n_loaders, prepare_data, maxlen=maxlen,
+                                       n_words_src=n_words_src, n_words=n_words)
+        train = BatchPrefetcher(train, None, n_ready=0)
+    else:
+        train = BatchPrefetcher(train, prepare_data, n_ready=prefetch, maxlen=maxlen,
+                                n_words_src=n_words_src, n_words=n_words)
 
     print 'Building model'
     params = init_params(model_options)
@@ -1761,15 +2128,21 @@ def train(dim_word=100, # word vector dimensionality
 
     #theano.printing.debugprint(cost.mean(), file=open('cost.txt', 'w'))
 
-    print 'Buliding sampler'
-    f_init, f_next = build_sampler(tparams, model_options, trng)
+    # only f_update is needed for training, the other functions are compiled
+    # when sampleFreq, validFreq or the end of training first call them (and
+    # f_cost, f_grad not at all) unless lazy_compile is False
+    sampler = Lazy('sampler', build_sampler, tparams, model_options, trng, cache_dir=cache_dir)
 
     # before any regularizer
-    print 'Building f_log_probs...',
-    f_log_probs = theano.function(inps, cost, profile=profile)
-    print 'Done'
+    f_log_probs = Lazy('f_log_probs', compile_function, inps, cost, name='f_log_probs', profile=profile, cache_dir=cache_dir)
 
-    cost = cost.mean()
+    # max_tokens batches hold many short or few long sentences, a mean per
+    # target token keeps the step size independent of that (the cost shown
+    # during training is then per token)
+    if max_tokens:
+        cost = cost.sum() / y_mask.sum()
+    else:
+        cost = cost.mean()
 
     if decay_c > 0.:
         decay_c = theano.shared(numpy.float32(decay_c), name='decay_c')
@@ -1786,21 +2159,16 @@ def train(dim_word=100, # word vector dimensionality
         cost += alpha_reg
 
     # after any regularizer
-    print 'Building f_cost...',
-    f_cost = theano.function(inps, cost, profile=profile)
-    print 'Done'
+    f_cost = Lazy('f_cost', compile_function, inps, cost, name='f_cost', profile=profile, cache_dir=cache_dir)
 
     if model_options['hiero'] != None:
-        print 'Building f_beta...',
-        f_beta = theano.function([x, x_mask], opt_ret['hiero_betas'], profile=profile)
-        print 'Done'
+        f_beta = Lazy('f_beta', compile_function, [x, x_mask], opt_ret['hiero_betas'],
+                      name='f_beta', profile=profile, cache_dir=cache_dir)
 
     print 'Computing gradient...',
     grads = tensor.grad(cost, wrt=itemlist(tparams))
     print 'Done'
-    print 'Building f_grad...',
-    f_grad = theano.function(inps, grads, profile=profile)
-    print 'Done'
+    f_grad = Lazy('f_grad', compile_function, inps, grads, name='f_grad', profile=profile, cache_dir=cache_dir)
 
     #Cliping gradients
     if clip_c > 0.:
@@ -1817,15 +2185,25 @@ def train(dim_word=100, # word vector dimensionality
     lr = tensor.scalar(name='lr')
     print 'Building optimizers...',
     #f_grad_shared, f_update = eval(optimizer)(lr, tparams, grads, inps, cost)
-    f_update = eval(optimizer)(lr, tparams, grads, inps, cost)
+    f_update = eval(optimizer)(lr, tparams, grads, inps, cost, cache_dir=cache_dir)
     print 'Done'
 
+    if not lazy_compile:
+        for ff in [sampler, f_log_probs, f_cost, f_grad]:
+            ff.get()
+        if model_options['hiero'] != None:
+            f_beta.get()
+
     print 'Optimization'
 
     history_errs = []
-    # reload history
+    train_state = None
+    # reload history and the position in the training data
     if reload_ and os.path.exists(saveto):
-        history_errs = list(numpy.load(saveto)['history_errs'])
+        rmodel = numpy.load(saveto)
+        history_errs = list(rmodel['history_errs'])
+        if 'train_state' in rmodel:
+            train_state = pkl.loads(rmodel['train_state'].item())
     best_p = None
     bad_count = 0
 
@@ -1837,23 +2215,30 @@ def train(dim_word=100, # word vector dimensionality
         sampleFreq = len(train[0])/batch_size
 
     uidx = 0
+    start_epoch = 0
+    if train_state != None:
+        uidx = train_state['uidx']
+        start_epoch = train_state['eidx']
+        print 'Resuming at epoch', start_epoch, 'update', uidx
+
     estop = False
-    for eidx in xrange(max_epochs):
+    for eidx in xrange(start_epoch, max_epochs):
         n_samples = 0
+        epoch_wait = train.wait_time
         #import ipdb; ipdb.set_trace()
-        train.start()
-        for x, y in train:
-            n_samples += len(x)
+        if train_state != None and eidx == start_epoch:
+            train.set_state(train_state['iterator'])
+        else:
+            train.start()
+        for x, x_mask, y, y_mask in train:
             uidx += 1
             use_noise.set_value(1.)
 
-            x, x_mask, y, y_mask = prepare_data(x, y, maxlen=maxlen, 
-                                                n_words_src=n_words_src, n_words=n_words)
-
-            if x == None:
+            if x is None:
                 #print 'Minibatch with zero sample under length ', maxlen
                 uidx -= 1
                 continue
+            n_samples += x.shape[1]
 
             ud_start = time.time()
             #cost = f_grad_shared(x, x_mask, y, y_mask)
@@ -1866,7 +2251,11 @@ def train(dim_word=100, # word vector dimensionality
                 return 1., 1., 1.
 
             if numpy.mod(uidx, dispFreq) == 0:
-                print 'Epoch ', eidx, 'Update ', uidx, 'Cost ', cost, 'UD ', ud
+                # the cost is the mean per target token of the minibatch
+                # with max_tokens, per sentence otherwise; tokens/s shows the
+                # throughput and Wait the time spent waiting for this minibatch
+                print 'Epoch ', eidx, 'Update ', uidx, 'Cost ', cost, 'UD ', ud, \
+                      'Wait ', train.last_wait, 'Tok/s ', int((x_mask.sum() + y_mask.sum()) / ud)
 
             if numpy.mod(uidx, saveFreq) == 0:
                 print 'Saving...',
@@ -1881,35 +2270,31 @@ def train(dim_word=100, # word vector dimensionality
                 saveto_list = saveto.split('/')
                 saveto_list[-1] = 'epoch' + str(eidx) + '_' + 'nbUpd' + str(uidx) + '_' + saveto_list[-1]
                 saveName = '/'.join(saveto_list)
-                numpy.savez(saveName, history_errs=history_errs, **params)
+                train_state = {'eidx': eidx, 'uidx': uidx, 'iterator': train.get_state()}
+                numpy.savez(saveName, history_errs=history_errs,
+                            train_state=pkl.dumps(train_state), **params)
                 pkl.dump(model_options, open('%s.pkl'%saveName, 'wb'))
+                # saveto too, which is what reload_ reads, written aside and
+                # renamed so that an interrupted save leaves the previous one
+                tmp = '%s.%d' % (saveto, os.getpid())
+                with open(tmp, 'wb') as f:
+                    numpy.savez(f, history_errs=history_errs,
+                                train_state=pkl.dumps(train_state), **params)
+                os.rename(tmp, saveto)
+                pkl.dump(model_options, open('%s.pkl'%saveto, 'wb'))
                 print 'Done'
 
             if numpy.mod(uidx, sampleFreq) == 0:
                 # FIXME: random selection?
-                for jj in xrange(numpy.minimum(5,x.shape[1])):
-                    stochastic = False
-                    sample, score = gen_sample(tparams, f_init, f_next, x[:,jj][:,None], 
-                                               model_options, trng=trng, k=1, maxlen=30, 
-                                               stochastic=stochastic, argmax=True)
-                    print 'Source ',jj,': ',
-                    for vv in x[:,jj]:
-                        if vv == 0:
-                            break
-                        if vv in word_idict_src:
-                            print word_idict_src[vv], 
-                        else:
-                            print 'UNK',
-                    print
-                    print 'Truth ',jj,' : ',
-                    for vv in y[:,jj]:
-                        if vv == 0:
-                            break
-                        if vv in word_idict:
-                            print word_idict[vv], 
-                        else:
-                            print 'UNK',
-                    print
+                n_show = numpy.minimum(5,x.shape[1])
+                f_init, f_next = sampler.get()
+                samples, scores = gen_sample_batch(tparams, f_init, f_next, 
+                                                   x[:,:n_show], x_mask[:,:n_show], 
+                                                   model_options, trng=trng, k=1, maxlen=30)
+                for jj in xrange(n_show):
+                    sample, score = samples[jj], scores[jj]
+                    print 'Source ',jj,': ', vocab_src.decode(x[:,jj])
+                    print 'Truth ',jj,' : ', vocab.decode(y[:,jj])
                     if model_options['hiero']:
                         betas = f_beta(x[:,jj][:,None], x_mask[:,jj][:,None])
                         print 'Validity ', jj,': ',
@@ -1919,19 +2304,8 @@ def train(dim_word=100, # word vector dimensionality
                             print bb,
                         print
                     print 'Sample ', jj, ': ',
-                    if stochastic:
-                        ss = sample
-                    else:
-                        score = score / numpy.array([len(s) for s in sample])
-                        ss = sample[score.argmin()]
-                    for vv in ss:
-                        if vv == 0:
-                            break
-                        if vv in word_idict:
-                            print word_idict[vv], 
-                        else:
-                            print 'UNK',
-                    print
+                    score = score / numpy.array([len(s) for s in sample])
+                    print vocab.decode(sample[score.argmin()])
 
             if numpy.mod(uidx, validFreq) == 0:
                 use_noise.set_value(0.)
@@ -1969,8 +2343,11 @@ def train(dim_word=100, # word vector dimensionality
 
         #print 'Seen %d samples'%n_samples
 
+        print 'Epoch ', eidx, 'waited %.1fs for data' % (train.wait_time - epoch_wait)
+
         if estop:
             break
+    train.close()
 
     if best_p is not None: 
         zipp(best_p, tparams)
@@ -1992,16 +2369,23 @@ def train(dim_word=100, # word vector dimensionality
         params = copy.copy(best_p)
     else:
         params = unzip(tparams)
+    train_state = {'eidx': eidx, 'uidx': uidx, 'iterator': train.get_state()}
     numpy.savez(saveto, zipped_params=best_p, train_err=train_err, 
                 valid_err=valid_err, test_err=test_err, history_errs=history_errs, 
-                **params)
+                train_state=pkl.dumps(train_state), **params)
 
     return train_err, valid_err, test_err
 
 
 
 if __name__ == '__main__':
-    pass
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str)
+    parser.add_argument('saveto', type=str)
+
+    args = parser.parse_args()
+
+    convert_params(args.model, args.saveto)
 
 
 
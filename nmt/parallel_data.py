@@ -0,0 +1,223 @@
+"""
+Multi-process minibatch loading.
+
+Worker processes read the bitext and run prepare_data themselves, the padded
+arrays are written into shared-memory slots instead of being pickled back.
+The wrapped iterator provides the batch schedule, which this process walks
+once, handing every n_workers-th batch to each worker, and opens the files
+in the workers. Batches are consumed round-robin, so their order and states
+are those of the wrapped iterator.
+"""
+import numpy as np
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import logging
+import cPickle as pkl
+
+from data_utils import BufferPool, read_sentences
+
+logger = logging.getLogger(__name__)
+
+# BufferPool whose slots are fixed shared-memory arrays chosen by the caller
+class SharedSlotPool(BufferPool):
+    def __init__(self, slots):
+        self.slots = slots
+        self.cur = 0
+
+    def next_slot(self):
+        return self.slots[self.cur]
+
+    def get(self, slot, name, shape, dtype):
+        size = shape[0] * shape[1]
+        assert size <= slot[name].size and slot[name].dtype == np.dtype(dtype)
+        return slot[name][:size].reshape(shape)
+
+# whether iterator (an instance or a class) provides what
+# ParallelBitextIterator needs
+def supported(iterator):
+    return all(hasattr(iterator, kk) for kk in ['open_stores', 'start_state', 'batch_schedule'])
+
+# builds the batches sent on cmd_queue, as (sentence indices, state), until
+# a None; an error is put on out_queue in place of the next batch, for next()
+# to raise it
+def load_worker(wid, diter, free_queue, cmd_queue, out_queue):
+    try:
+        source, target = diter.iterator.open_stores()
+        pool = SharedSlotPool(diter.buffers[wid])
+
+        while True:
+            cmd = cmd_queue.get()
+            if cmd == None:
+                break
+            idxs, state = cmd
+            pool.cur = free_queue.get()
+            x, x_mask, y, y_mask = diter.prepare_data(read_sentences(source, idxs),
+                                                      read_sentences(target, idxs),
+                                                      maxlen=diter.maxlen,
+                                                      n_words_src=diter.n_words_src,
+                                                      n_words=diter.n_words, pool=pool)
+            if x is None:
+                out_queue.put((state, pool.cur, None, None))
+            else:
+                out_queue.put((state, pool.cur, x.shape, y.shape))
+        source.close()
+        target.close()
+    except Exception, e:
+        # the queue pickles it, which not every exception supports
+        try:
+            pkl.dumps(e)
+        except Exception:
+            e = RuntimeError('%s: %s' % (type(e).__name__, e))
+        out_queue.put(e)
+        return
+    out_queue.put(None)
+
+class ParallelBitextIterator(object):
+    """
+    Wraps a bitext iterator and yields prepared (x, x_mask, y, y_mask)
+    minibatches, or four Nones when prepare_data drops a whole batch. The
+    arrays live in shared memory and stay valid until the following call to
+    next.
+
+    The iterator must provide open_stores(), start_state(start_offset,
+    data_len, state) and batch_schedule(source_lengths, target_lengths,
+    state), see PytablesBitextIterator; get_state() is the state after the
+    last batch returned.
+
+    Workers are forked in start, which must not happen while a thread of
+    this process is inside PyTables (e.g. a running PytablesBitextFetcher).
+    """
+    def __init__(self, iterator, n_workers, prepare_data, maxlen=None,
+                 n_words_src=30000, n_words=30000, n_slots=2):
+        self.workers = []
+        if not supported(iterator):
+            raise ValueError('%s does not support parallel loading' %
+                             type(iterator).__name__)
+        self.iterator = iterator
+        self.batch_size = iterator.batch_size
+        self.max_len = iterator.max_len
+        self.n_workers = n_workers
+        self.prepare_data = prepare_data
+        self.maxlen = maxlen
+        self.n_words_src = n_words_src
+        self.n_words = n_words
+        self.n_slots = n_slots
+
+        source, target = iterator.open_stores()
+        self.source_lengths = np.array(source.lengths)
+        self.target_lengths = np.array(target.lengths)
+        source.close()
+        target.close()
+        self.data_len = len(self.source_lengths)
+        max_rows = max(int(self.source_lengths.max()), int(self.target_lengths.max())) + 1
+        size = self.batch_size * min(max_rows, self.max_len + 1)
+
+        # allocated before the workers are forked, so they share the pages
+        self.buffers = []
+        for wid in xrange(n_workers):
+            slots = []
+            for ss in xrange(n_slots):
+                slot = dict()
+                for name, dtype in [('x', 'int64'), ('x_mask', 'float32'),
+                                    ('y', 'int64'), ('y_mask', 'float32')]:
+                    raw = RawArray('b', size * np.dtype(dtype).itemsize)
+                    slot[name] = np.frombuffer(raw, dtype=dtype)
+                slots.append(slot)
+            self.buffers.append(slots)
+        self.state = None
+
+    def run(self, state):
+        self.close()
+        self.state = state
+        self.schedule = self.iterator.batch_schedule(self.source_lengths,
+                                                     self.target_lengths, state)
+
+        self.free_queues = []
+        self.cmd_queues = []
+        self.out_queues = []
+        self.workers = []
+        for wid in xrange(self.n_workers):
+            free_queue = multiprocessing.Queue()
+            cmd_queue = multiprocessing.Queue()
+            out_queue = multiprocessing.Queue()
+            for ss in xrange(self.n_slots):
+                free_queue.put(ss)
+            worker = multiprocessing.Process(target=load_worker,
+                                             args=(wid, self, free_queue, cmd_queue, out_queue))
+            worker.daemon = True
+            worker.start()
+            self.free_queues.append(free_queue)
+            self.cmd_queues.append(cmd_queue)
+            self.out_queues.append(out_queue)
+            self.workers.append(worker)
+        self.bidx = 0
+        self.n_sent = 0
+        self.in_use = None
+        self.send()
+
+    # keep every worker n_slots + 1 batches ahead of the consumer
+    def send(self):
+        while self.schedule != None and \
+                self.n_sent < self.bidx + self.n_workers * (self.n_slots + 1):
+            wid = self.n_sent % self.n_workers
+            try:
+                self.cmd_queues[wid].put(next(self.schedule))
+            except StopIteration:
+                for cmd_queue in self.cmd_queues:
+                    cmd_queue.put(None)
+                self.schedule = None
+                break
+            self.n_sent += 1
+
+    def start(self, start_offset=0):
+        self.run(self.iterator.start_state(start_offset, self.data_len, self.state))
+
+    # position to resume from, saved with the checkpoints
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.run(state)
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.workers = []
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.in_use != None:
+            self.free_queues[self.in_use[0]].put(self.in_use[1])
+            self.in_use = None
+
+        wid = self.bidx % self.n_workers
+        resp = self.out_queues[wid].get()
+        if resp == None:
+            self.close()
+            raise StopIteration
+        if isinstance(resp, Exception):
+            self.close()
+            raise resp
+        self.bidx += 1
+        self.send()
+
+        self.state, slot, x_shape, y_shape = resp
+        self.in_use = (wid, slot)
+        if x_shape == None:
+            return None, None, None, None
+
+        buffers = self.buffers[wid][slot]
+        x_size = x_shape[0] * x_shape[1]
+        y_size = y_shape[0] * y_shape[1]
+        return (buffers['x'][:x_size].reshape(x_shape),
+                buffers['x_mask'][:x_size].reshape(x_shape),
+                buffers['y'][:y_size].reshape(y_shape),
+                buffers['y_mask'][:y_size].reshape(y_shape))
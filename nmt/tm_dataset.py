@@ -21,13 +21,56 @@ import Queue
 
 import collections
 
+from data_utils import batch_schedule, open_corpus
+
 logger = logging.getLogger(__name__)
 
+def open_table(fname, table_name, index_name, driver=None):
+    if tables.__version__[0] == '2':
+        table = tables.openFile(fname, 'r')
+        return table, table.getNode(table_name), table.getNode(index_name)
+    table = tables.open_file(fname, 'r', driver=driver)
+    return table, table.get_node(table_name), table.get_node(index_name)
+
+class PytablesBitextStore(object):
+    """
+    One side of a bitext, with the whole index table held in memory so that
+    a range of sentences is fetched with a single contiguous data read.
+    """
+    def __init__(self, fname, table_name='/phrases', index_name='/indices', driver=None):
+        self.table, self.data, index = open_table(fname, table_name, index_name, driver)
+        indices = index.read()
+        self.lengths = indices['length'].astype('int64')
+        self.pos = indices['pos'].astype('int64')
+
+    def __len__(self):
+        return self.lengths.shape[0]
+
+    def read(self, start, end, dtype='int64'):
+        pos = self.pos[start:end]
+        lengths = self.lengths[start:end]
+        if pos.shape[0] == 0:
+            return []
+        lo = pos.min()
+        chunk = self.data[lo:(pos + lengths).max()].astype(dtype)
+        return [chunk[pp:pp + ll] for pp, ll in zip(pos - lo, lengths)]
+
+    def close(self):
+        self.table.close()
+
 class PytablesBitextFetcher(threading.Thread):
-    def __init__(self, parent, start_offset):
+    """
+    Persistent worker of a PytablesBitextIterator: the files stay open and
+    each (generation, offset) command received from start() runs one pass
+    over the data. Batches are tagged with their generation, a pass is
+    abandoned as soon as the iterator is restarted or closed.
+    """
+    def __init__(self, parent):
         threading.Thread.__init__(self)
-        self.parent = parent
-        self.start_offset = start_offset
+        # a weak reference, so that a dropped iterator can still be collected
+        # and close its fetcher from __del__
+        self.parent = weakref.proxy(parent)
+        self.commands = Queue.Queue()
 
     def run(self):
         diter = self.parent
@@ -36,28 +79,36 @@ class PytablesBitextFetcher(threading.Thread):
         if diter.can_fit:
             driver = "H5FD_CORE"
 
-        if tables.__version__[0] == '2':
-            target_table = tables.openFile(diter.target_file, 'r')
-            target_data, target_index = (target_table.getNode(diter.table_name),
-                                         target_table.getNode(diter.index_name))
-        else:
-            target_table = tables.open_file(diter.target_file, 'r', driver=driver)
-            target_data, target_index = (target_table.get_node(diter.table_name),
-                                         target_table.get_node(diter.index_name))
-
-        if tables.__version__[0] == '2':
-            source_table = tables.openFile(diter.source_file, 'r')
-            source_data, source_index = (source_table.getNode(diter.table_name),
-                                         source_table.getNode(diter.index_name))
-        else:
-            source_table = tables.open_file(diter.source_file, 'r', driver=driver)
-            source_data, source_index = (source_table.get_node(diter.table_name),
-                                         source_table.get_node(diter.index_name))
-
-        assert source_index.shape[0] == target_index.shape[0]
-        data_len = source_index.shape[0]
-
-        offset = self.start_offset
+        target = PytablesBitextStore(diter.target_file, diter.table_name, diter.index_name, driver)
+        source = PytablesBitextStore(diter.source_file, diter.table_name, diter.index_name, driver)
+        assert len(source) == len(target)
+
+        try:
+            while True:
+                cmd = self.commands.get()
+                if cmd == None:
+                    break
+                self.fetch(source, target, cmd[0], cmd[1])
+        except ReferenceError:
+            pass
+        source.close()
+        target.close()
+
+    # False once the pass is abandoned
+    def put(self, generation, batch):
+        diter = self.parent
+        while generation == diter.generation and not diter.exit_flag:
+            try:
+                diter.queue.put([generation] + batch, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def fetch(self, source, target, generation, offset):
+        diter = self.parent
+        data_len = len(source)
+
         if offset == -1:
             offset = 0
             if diter.shuffle:
@@ -65,34 +116,51 @@ class PytablesBitextFetcher(threading.Thread):
         logger.debug("{} entries".format(data_len))
         logger.debug("Starting from the entry {}".format(offset))
 
-        while not diter.exit_flag:
-            last_batch = False
-            source_sents = []
-            target_sents = []
-            while len(source_sents) < diter.batch_size:
-                if offset == data_len:
-                    if diter.use_infinite_loop:
-                        offset = 0
-                    else:
-                        last_batch = True
-                        break
-
-                slen, spos = source_index[offset]['length'], source_index[offset]['pos']
-                tlen, tpos = target_index[offset]['length'], target_index[offset]['pos']
-                offset += 1
-
-                if slen > diter.max_len or tlen > diter.max_len:
-                    continue
-                source_sents.append(source_data[spos:spos + slen].astype(diter.dtype))
-                target_sents.append(target_data[tpos:tpos + tlen].astype(diter.dtype))
-
-            if len(source_sents):
-                diter.queue.put([int(offset), source_sents, target_sents])
-            if last_batch:
-                diter.queue.put([None])
-                source_table.close()
-                target_table.close()
-                return
+        # cache_size sentences are read at once and split into batches, a
+        # batch is tagged with the offset following its last sentence; with
+        # max_tokens a batch is also cut before its padded source and target
+        # tokens (as laid out by prepare_data) exceed the budget
+        source_sents = []
+        target_sents = []
+        max_x = max_y = 0
+        while True:
+            if offset == data_len:
+                if diter.use_infinite_loop:
+                    offset = 0
+                else:
+                    if len(source_sents):
+                        if not self.put(generation, [int(offset), source_sents, target_sents]):
+                            return
+                    self.put(generation, [None])
+                    return
+
+            end = min(offset + diter.cache_size, data_len)
+            keep = np.flatnonzero((source.lengths[offset:end] <= diter.max_len) &
+                                  (target.lengths[offset:end] <= diter.max_len))
+            chunk_source = source.read(offset, end, diter.dtype)
+            chunk_target = target.read(offset, end, diter.dtype)
+            for ii in keep:
+                len_x = len(chunk_source[ii]) + 1
+                len_y = len(chunk_target[ii]) + 1
+                if diter.max_tokens and len(source_sents) and \
+                        (len(source_sents) + 1) * (max(max_x, len_x) + max(max_y, len_y)) > diter.max_tokens:
+                    if not self.put(generation, [int(last_offset), source_sents, target_sents]):
+                        return
+                    source_sents = []
+                    target_sents = []
+                    max_x = max_y = 0
+                source_sents.append(chunk_source[ii])
+                target_sents.append(chunk_target[ii])
+                max_x = max(max_x, len_x)
+                max_y = max(max_y, len_y)
+                last_offset = offset + ii + 1
+                if len(source_sents) == diter.batch_size:
+                    if not self.put(generation, [int(last_offset), source_sents, target_sents]):
+                        return
+                    source_sents = []
+                    target_sents = []
+                    max_x = max_y = 0
+            offset = end
 
 class PytablesBitextIterator(object):
 
@@ -108,34 +176,95 @@ class PytablesBitextIterator(object):
                  cache_size=1000,
                  shuffle=True,
                  use_infinite_loop=True,
-                 max_len=1000):
+                 max_len=1000,
+                 max_tokens=None):
 
         args = locals()
         args.pop("self")
         self.__dict__.update(args)
 
         self.exit_flag = False
+        self.generation = 0
+        self.exhausted = True
+        self.gather = None
+        self.queue = Queue.Queue(maxsize=self.queue_size)
 
+    # (re)start a pass at start_offset, the fetcher thread is created on the
+    # first call and reused afterwards
     def start(self, start_offset=0):
-        self.queue = Queue.Queue(maxsize=self.queue_size)
-        self.gather = PytablesBitextFetcher(self, start_offset)
-        self.gather.daemon = True
-        self.gather.start()
+        self.next_offset = start_offset
+        self.generation += 1
+        self.exhausted = False
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        if self.gather == None:
+            self.gather = PytablesBitextFetcher(self)
+            self.gather.daemon = True
+            self.gather.start()
+        self.gather.commands.put((self.generation, start_offset))
+
+    # position to resume from, saved with the checkpoints
+    def get_state(self):
+        return {'offset': self.next_offset}
+
+    def set_state(self, state):
+        self.start(state['offset'])
+
+    # for ParallelBitextIterator: the files, the state of a pass started at
+    # start_offset, and the batches from a state on as (sentence indices,
+    # state after the batch), the same as those of the fetcher
+    def open_stores(self):
+        driver = "H5FD_CORE" if self.can_fit else None
+        return (open_corpus(self.source_file, self.table_name, self.index_name, driver),
+                open_corpus(self.target_file, self.table_name, self.index_name, driver))
+
+    def start_state(self, start_offset, data_len, state=None):
+        offset = start_offset
+        if offset == -1:
+            offset = 0
+            if self.shuffle:
+                offset = np.random.randint(data_len)
+        return {'offset': offset}
+
+    def batch_schedule(self, source_lengths, target_lengths, state):
+        for idxs, next_offset in batch_schedule(source_lengths, target_lengths, self.batch_size,
+                                                self.max_len, state['offset'],
+                                                self.use_infinite_loop, self.max_tokens):
+            yield idxs, {'offset': next_offset}
+
+    # stop the fetcher thread and close the files, start() opens them again
+    def close(self):
+        if self.gather == None:
+            return
+        self.exit_flag = True
+        self.gather.commands.put(None)
+        self.gather.join()
+        self.gather = None
+        self.exit_flag = False
+        self.exhausted = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __del__(self):
-        if hasattr(self, 'gather'):
-            self.gather.exitFlag = True
-            self.gather.join()
+        self.close()
 
     def __iter__(self):
         return self
 
     def next(self):
-        batch = self.queue.get()
-        if not batch:
+        if self.exhausted:
             raise StopIteration
-        if len(batch) < 2:
+        while True:
+            batch = self.queue.get()
+            # left over from a pass abandoned by start()
+            if batch[0] == self.generation:
+                break
+        if batch[1] == None:
+            self.exhausted = True
             raise StopIteration
-        self.next_offset = batch[0]
-        return batch[1], batch[2]
-
+        self.next_offset = batch[1]
+        return batch[2], batch[3]
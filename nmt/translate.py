@@ -1,16 +1,22 @@
 import argparse
+import os
 
 import numpy
 import cPickle as pkl
 
-from nmt import build_sampler, gen_sample, \
-                load_params, \
+from nmt import build_sampler, gen_sample_batch, build_shortlist, \
+                load_params, unpack_params, \
                 init_params, \
                 init_tparams
+from vocab import Vocabulary
 
 from multiprocessing import Process, Queue
+from threading import Thread
 
-def translate_model(queue, rqueue, pid, model, options, k, normalize):
+# load a model and compile its sampler, returns a function translating a
+# list of source id sequences (each ending with <eos>) as one minibatch;
+# with a cache_dir the sampler compiled by an earlier run is reused
+def load_translator(model, options, k, normalize, lex_table=None, n_frequent=0, cache_dir=None):
 
     import theano
     from theano import tensor
@@ -21,107 +27,172 @@ def translate_model(queue, rqueue, pid, model, options, k, normalize):
 
     params = init_params(options)
     params = load_params(model, params)
-    tparams = init_tparams(params)
+    # parameters memory-mapped from an unpacked model are shared, not copied
+    tparams = init_tparams(params, borrow=os.path.isdir(model))
 
     # word index
-    f_init, f_next = build_sampler(tparams, options, trng)
+    f_init, f_next = build_sampler(tparams, options, trng, shortlist=lex_table is not None,
+                                   cache_dir=cache_dir)
+
+    def _translate(seqs):
+        lengths = [len(s) for s in seqs]
+        x = numpy.zeros((numpy.max(lengths), len(seqs))).astype('int64')
+        x_mask = numpy.zeros((numpy.max(lengths), len(seqs))).astype('float32')
+        for idx, seq in enumerate(seqs):
+            x[:lengths[idx],idx] = seq
+            x_mask[:lengths[idx],idx] = 1.
+        shortlist = None
+        if lex_table is not None:
+            shortlist = build_shortlist(x, lex_table, n_frequent, options['n_words'])
+        samples, scores = gen_sample_batch(tparams, f_init, f_next, x, x_mask, options,
+                                           trng=trng, k=k, maxlen=200, shortlist=shortlist)
+        trans = []
+        for sample, score in zip(samples, scores):
+            if normalize:
+                lengths = numpy.array([len(s) for s in sample])
+                score = score / lengths
+            sidx = numpy.argmin(score)
+            trans.append(sample[sidx])
+        return trans
+
+    return _translate
 
-    def _translate(seq):
-        sample, score = gen_sample(tparams, f_init, f_next, numpy.array(seq).reshape([len(seq),1]), options,
-                                   trng=trng, k=k, maxlen=200, stochastic=False)
-        if normalize:
-            lengths = numpy.array([len(s) for s in sample])
-            score = score / lengths
-        sidx = numpy.argmin(score)
-        return sample[sidx]
+def translate_model(queue, rqueue, pid, model, options, k, normalize, lex_table=None, n_frequent=0,
+                    cache_dir=None):
+
+    _translate = load_translator(model, options, k, normalize, 
+                                 lex_table=lex_table, n_frequent=n_frequent, cache_dir=cache_dir)
 
     while True:
         req = queue.get()
         if req == None:
+            rqueue.put(None)
             break
 
-        idx, x = req[0], req[1]
-        print pid, '-', idx
-        seq = _translate(x)
+        idxs, xs = req[0], req[1]
+        print pid, '-', idxs[0]
+        seqs = _translate(xs)
 
-        rqueue.put((idx, seq))
+        rqueue.put((idxs, seqs))
 
     return 
 
-def main(model, dictionary, dictionary_target, source_file, saveto, k=5, normalize=False, n_process=5, chr_level=False):
+# lexical table for shortlist decoding: source word -> target words, stored
+# as a pickled dict of words and returned with word ids
+def load_lex_table(path, vocab, vocab_trg):
+    with open(path, 'rb') as f:
+        lex_words = pkl.load(f)
+    lex_ids = dict()
+    for kk, vv in lex_words.iteritems():
+        idx = vocab.index(kk)
+        if idx != None:
+            lex_ids[idx] = [ii for ii in map(vocab_trg.index, vv) if ii != None]
+    return lex_ids
+
+# number of complete lines in an output file, a trailing partial line left by
+# an interrupted run is cut off
+def count_done_lines(fname):
+    if not os.path.exists(fname):
+        return 0
+    n_done = 0
+    size = 0
+    with open(fname, 'rb') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            n_done += 1
+            size += len(line)
+    with open(fname, 'ab') as f:
+        f.truncate(size)
+    return n_done
+
+def main(model, dictionary, dictionary_target, source_file, saveto, k=5, normalize=False, n_process=5, chr_level=False, batch_size=1, lex_table=None, n_frequent=2000, mmap=False, resume=False, sort_window=20, cache_dir=None):
 
     # load model model_options
     with open('%s.pkl'%model, 'rb') as f:
         options = pkl.load(f)
 
-    with open(dictionary, 'rb') as f:
-        word_dict = pkl.load(f)
-    word_idict = dict()
-    for kk, vv in word_dict.iteritems():
-        word_idict[vv] = kk
-    word_idict[0] = '<eos>'
-    word_idict[1] = 'UNK'
-    with open(dictionary_target, 'rb') as f:
-        word_dict_trg = pkl.load(f)
-    word_idict_trg = dict()
-    for kk, vv in word_dict_trg.iteritems():
-        word_idict_trg[vv] = kk
-    word_idict_trg[0] = '<eos>'
-    word_idict_trg[1] = 'UNK'
-
-    queue = Queue()
+    vocab = Vocabulary.load(dictionary, n_words=options['n_words'])
+    vocab_trg = Vocabulary.load(dictionary_target)
+
+    lex_ids = None
+    if lex_table:
+        lex_ids = load_lex_table(lex_table, vocab, vocab_trg)
+
+    # all workers map the same uncompressed copy of the parameters
+    if mmap:
+        model = unpack_params(model)
+
+    # bounded, so only a few jobs per worker are read ahead of the decoder
+    queue = Queue(maxsize=2 * n_process)
     rqueue = Queue()
     processes = [None] * n_process
     for midx in xrange(n_process):
         processes[midx] = Process(target=translate_model, 
-                                  args=(queue,rqueue,midx,model,options,k,normalize,))
+                                  args=(queue,rqueue,midx,model,options,k,normalize,lex_ids,n_frequent,cache_dir,))
         processes[midx].start()
 
-    def _seqs2words(caps):
-        capsw = []
-        for cc in caps:
-            ww = []
-            for w in cc:
-                if w == 0:
-                    break
-                ww.append(word_idict_trg[w])
-            capsw.append(' '.join(ww))
-        return capsw
-
-    def _send_jobs(fname):
+    def _send_chunks(idxs, xs):
+        # lines of similar length are decoded together, longest first so
+        # that the slowest chunks do not end up last on a single worker
+        order = numpy.argsort([-len(x) for x in xs], kind='mergesort')
+        for ii in xrange(0, len(order), batch_size):
+            chunk = order[ii:ii+batch_size]
+            queue.put(([idxs[jj] for jj in chunk], [xs[jj] for jj in chunk]))
+
+    def _send_jobs(fname, start):
+        # sort_window chunks worth of lines are read ahead, encoded at once
+        # and bucketed by length, output order is restored by _retrieve_jobs
+        window = max(1, sort_window) * batch_size
+        idxs, lines = [], []
         with open(fname, 'r') as f:
             for idx, line in enumerate(f):
-                if chr_level:
-                    words = list(line.decode('utf-8').strip())
-                else:
-                    words = line.strip().split()
-                x = map(lambda w: word_dict[w] if w in word_dict else 1, words)
-                x = map(lambda ii: ii if ii < options['n_words'] else 1, x)
-                x += [0]
-                queue.put((idx, x))
-        return idx+1
-
-    def _finish_processes():
+                if idx < start:
+                    continue
+                idxs.append(idx)
+                lines.append(line)
+                if len(lines) == window:
+                    _send_chunks(idxs, vocab.encode_batch(lines, chr_level=chr_level))
+                    idxs, lines = [], []
+        if len(lines):
+            _send_chunks(idxs, vocab.encode_batch(lines, chr_level=chr_level))
         for midx in xrange(n_process):
             queue.put(None)
 
-    def _retrieve_jobs(n_samples):
-        trans = [None] * n_samples
-        for idx in xrange(n_samples):
+    def _retrieve_jobs(f, start):
+        # finished lines wait in a reorder buffer until all lines before them
+        # are written, every worker answers None once it is out of jobs
+        done = dict()
+        next_idx = start
+        n_finished = 0
+        while n_finished < n_process:
             resp = rqueue.get()
-            trans[resp[0]] = resp[1]
-            if numpy.mod(idx, 10) == 0:
-                print 'Sample ', (idx+1), '/', n_samples, ' Done'
-        return trans
+            if resp == None:
+                n_finished += 1
+                continue
+            for idx, line in zip(resp[0], vocab_trg.decode_batch(resp[1])):
+                done[idx] = line
+            while next_idx in done:
+                f.write(done.pop(next_idx) + '\n')
+                if numpy.mod(next_idx, 10) == 0:
+                    print 'Sample ', (next_idx+1), ' Done'
+                next_idx += 1
+            f.flush()
+        return next_idx
+
+    start = 0
+    if resume:
+        start = count_done_lines(saveto)
+        print 'Resuming from line', start
 
     print 'Translating ',source_file,'...'
-    n_samples = _send_jobs(source_file)
-    trans = _seqs2words(_retrieve_jobs(n_samples))
-    _finish_processes()
-    with open(saveto, 'w') as f:
-        print >>f, '\n'.join(trans)
-    print 'Done'
-
+    sender = Thread(target=_send_jobs, args=(source_file, start))
+    sender.daemon = True
+    sender.start()
+    with open(saveto, 'a' if resume else 'w') as f:
+        n_samples = _retrieve_jobs(f, start)
+    sender.join()
+    print 'Done', n_samples, 'lines'
 
 
 if __name__ == "__main__":
@@ -130,6 +201,13 @@ if __name__ == "__main__":
     parser.add_argument('-p', type=int, default=5)
     parser.add_argument('-n', action="store_true", default=False)
     parser.add_argument('-c', action="store_true", default=False)
+    parser.add_argument('-b', type=int, default=1)
+    parser.add_argument('-s', type=str, default=None)
+    parser.add_argument('-f', type=int, default=2000)
+    parser.add_argument('-m', action="store_true", default=False)
+    parser.add_argument('-r', action="store_true", default=False)
+    parser.add_argument('-w', type=int, default=20)
+    parser.add_argument('-x', type=str, default=None)
     parser.add_argument('model', type=str)
     parser.add_argument('dictionary', type=str)
     parser.add_argument('dictionary_target', type=str)
@@ -138,4 +216,4 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    main(args.model, args.dictionary, args.dictionary_target, args.source, args.saveto, k=args.k, n_process=args.p, chr_level=args.c)
+    main(args.model, args.dictionary, args.dictionary_target, args.source, args.saveto, k=args.k, n_process=args.p, chr_level=args.c, batch_size=args.b, lex_table=args.s, n_frequent=args.f, mmap=args.m, resume=args.r, sort_window=args.w, cache_dir=args.x)
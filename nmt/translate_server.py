@@ -0,0 +1,155 @@
+'''
+Long-running translation service on top of translate.py
+
+The model is loaded and f_init/f_next compiled once. Clients connect to a
+local TCP socket and send one source sentence per line; each line is answered
+with its translation. Requests arriving within a short time window are
+grouped into a micro-batch and decoded together with gen_sample_batch.
+'''
+import argparse
+
+import numpy
+import cPickle as pkl
+
+import time
+import threading
+import Queue
+import SocketServer
+
+from translate import load_translator, load_lex_table
+from vocab import Vocabulary
+
+class MicroBatcher(threading.Thread):
+    def __init__(self, translate, batch_size=32, window=0.01, report_freq=100):
+        threading.Thread.__init__(self)
+        self.translate = translate
+        self.batch_size = batch_size
+        self.window = window
+        self.report_freq = report_freq
+
+        self.queue = Queue.Queue()
+        self.latencies = []
+        self.n_done = 0
+        self.daemon = True
+
+    # called from the connection threads, blocks until the line is translated;
+    # raises the exception of the batch if its translation failed
+    def submit(self, seq):
+        done = Queue.Queue(maxsize=1)
+        self.queue.put((time.time(), seq, done))
+        trans = done.get()
+        if isinstance(trans, Exception):
+            raise trans
+        return trans
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                trans = self.translate([req[1] for req in batch])
+            except Exception, e:
+                print 'Translation of a batch of %d failed: %r' % (len(batch), e)
+                for req in batch:
+                    req[2].put(e)
+                continue
+            now = time.time()
+            for req, seq in zip(batch, trans):
+                req[2].put(seq)
+                self.latencies.append(now - req[0])
+            self.n_done += len(batch)
+
+            if len(self.latencies) >= self.report_freq:
+                self.report()
+
+    def report(self):
+        if not self.latencies:
+            return
+        lat = 1000. * numpy.array(self.latencies)
+        self.latencies = []
+        print 'Requests %d Latency (ms) p50 %.1f p90 %.1f p99 %.1f max %.1f' % \
+              (self.n_done, numpy.percentile(lat, 50), numpy.percentile(lat, 90),
+               numpy.percentile(lat, 99), lat.max())
+
+class TranslationHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        for line in self.rfile:
+            seq = server.vocab.encode(line, chr_level=server.chr_level)
+            trans = server.batcher.submit(seq)
+            self.wfile.write(server.vocab_trg.decode(trans) + '\n')
+            self.wfile.flush()
+
+class TranslationServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def main(model, dictionary, dictionary_target, host='localhost', port=8080, k=5,
+         normalize=False, chr_level=False, batch_size=32, window=0.01,
+         lex_table=None, n_frequent=2000, report_freq=100):
+
+    # load model model_options
+    with open('%s.pkl'%model, 'rb') as f:
+        options = pkl.load(f)
+
+    vocab = Vocabulary.load(dictionary, n_words=options['n_words'])
+    vocab_trg = Vocabulary.load(dictionary_target)
+
+    lex_ids = None
+    if lex_table:
+        lex_ids = load_lex_table(lex_table, vocab, vocab_trg)
+
+    translate = load_translator(model, options, k, normalize,
+                                lex_table=lex_ids, n_frequent=n_frequent)
+    batcher = MicroBatcher(translate, batch_size=batch_size, window=window,
+                           report_freq=report_freq)
+    batcher.start()
+
+    server = TranslationServer((host, port), TranslationHandler)
+    server.options = options
+    server.chr_level = chr_level
+    server.vocab = vocab
+    server.vocab_trg = vocab_trg
+    server.batcher = batcher
+
+    print 'Serving on %s:%d' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    batcher.report()
+    server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('-n', action="store_true", default=False)
+    parser.add_argument('-c', action="store_true", default=False)
+    parser.add_argument('-b', type=int, default=32)
+    parser.add_argument('-w', type=float, default=0.01)
+    parser.add_argument('-s', type=str, default=None)
+    parser.add_argument('-f', type=int, default=2000)
+    parser.add_argument('-r', type=int, default=100)
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('model', type=str)
+    parser.add_argument('dictionary', type=str)
+    parser.add_argument('dictionary_target', type=str)
+
+    args = parser.parse_args()
+
+    main(args.model, args.dictionary, args.dictionary_target, host=args.host, port=args.port,
+         k=args.k, normalize=args.n, chr_level=args.c, batch_size=args.b, window=args.w,
+         lex_table=args.s, n_frequent=args.f, report_freq=args.r)
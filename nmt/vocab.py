@@ -0,0 +1,213 @@
+'''
+Word <-> id mapping of the dictionaries, encoding and decoding whole batches
+of lines at once
+
+Dictionaries are either pickled word -> id dicts or files in a compact format
+that is memory-mapped: a fixed-size header, the ids of the words in sorted
+order, the position of each id in that order (-1 for ids without a word) and
+the sorted words as fixed-width utf-8 strings.
+
+Usage: python vocab.py vocab.pkl vocab.bin
+'''
+import argparse
+
+import numpy
+import cPickle as pkl
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# word -> id table answering UNK (1) for unknown words, so that lookups are
+# a single map over the words
+class IdTable(dict):
+    def __missing__(self, key):
+        return 1
+
+MAGIC = 'NMTVOCB1'
+header_dtype = numpy.dtype([('magic', 'S8'), ('width', '<i8'),
+                            ('n_entries', '<i8'), ('n_ids', '<i8')])
+
+def utf8(word):
+    if isinstance(word, unicode):
+        return word.encode('utf-8')
+    return word
+
+# sorted words, their ids and the position of each id among them; an id
+# owned by several words decodes to the first of them, UNK (1) to 'UNK'
+def vocab_arrays(word_dict):
+    entries = sorted((utf8(kk), vv) for kk, vv in word_dict.iteritems())
+    width = max([1] + [len(kk) for kk, vv in entries])
+    table = numpy.array([kk for kk, vv in entries], dtype='S%d' % width)
+    ids = numpy.array([vv for kk, vv in entries], dtype='int64')
+
+    n_ids = max([2] + [vv + 1 for kk, vv in entries])
+    rank = -numpy.ones((n_ids,), dtype='int64')
+    rank[ids[::-1]] = numpy.arange(len(entries))[::-1]
+    rank[1] = -1
+    return table, ids, rank
+
+def write_vocab(fname, word_dict):
+    table, ids, rank = vocab_arrays(word_dict)
+    header = numpy.zeros((1,), dtype=header_dtype)
+    header['magic'] = MAGIC
+    header['width'] = table.dtype.itemsize
+    header['n_entries'] = table.shape[0]
+    header['n_ids'] = rank.shape[0]
+    with open(fname, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(ids.astype('<i8').tobytes())
+        f.write(rank.astype('<i8').tobytes())
+        f.write(table.tobytes())
+
+def convert_pickle(source, saveto):
+    with open(source, 'rb') as f:
+        word_dict = pkl.load(f)
+    write_vocab(saveto, word_dict)
+    logger.info("{}: {} words".format(saveto, len(word_dict)))
+
+def is_vocab_file(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# the arrays of a compact file, as read-only views of the map
+def map_vocab(fname):
+    header = numpy.fromfile(fname, dtype=header_dtype, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError('%s is not a compact vocabulary file' % fname)
+    n_entries, n_ids = int(header['n_entries']), int(header['n_ids'])
+    offset = header_dtype.itemsize
+    ids = numpy.asarray(numpy.memmap(fname, dtype='<i8', mode='r', offset=offset,
+                                     shape=(n_entries,)))
+    offset += ids.nbytes
+    rank = numpy.asarray(numpy.memmap(fname, dtype='<i8', mode='r', offset=offset,
+                                      shape=(n_ids,)))
+    offset += rank.nbytes
+    table = numpy.asarray(numpy.memmap(fname, dtype='S%d' % header['width'], mode='r',
+                                       offset=offset, shape=(n_entries,)))
+    return table, ids, rank
+
+class Vocabulary(object):
+    """
+    A dictionary of words to ids, where 0 is <eos> and 1 is UNK. Ids from
+    n_words on are encoded as UNK, as the model only knows the first n_words
+    ids; decoding stops at the first <eos>. Words are utf-8 strings.
+
+    Decoding indexes the (mapped) arrays directly. Encoding goes through a
+    word -> id hash table, built from the arrays on first use, which is
+    faster than a binary search in the sorted table.
+    """
+    def __init__(self, table, ids, rank, n_words=None):
+        self.table = table
+        self.ids = ids
+        self.rank = rank
+        self.n_words = n_words
+        self.id_table = None
+
+    @classmethod
+    def from_dict(cls, word_dict, n_words=None):
+        table, ids, rank = vocab_arrays(word_dict)
+        return cls(table, ids, rank, n_words=n_words)
+
+    # a compact file or a pickled dict
+    @classmethod
+    def load(cls, path, n_words=None):
+        if is_vocab_file(path):
+            table, ids, rank = map_vocab(path)
+            return cls(table, ids, rank, n_words=n_words)
+        with open(path, 'rb') as f:
+            word_dict = pkl.load(f)
+        return cls.from_dict(word_dict, n_words=n_words)
+
+    def __len__(self):
+        return self.rank.shape[0]
+
+    # id of a word, not clamped to n_words, None if it is unknown
+    def index(self, word):
+        word = utf8(word)
+        if len(word) > self.table.dtype.itemsize:
+            return None
+        pos = numpy.searchsorted(self.table, word)
+        if pos == self.table.shape[0] or self.table[pos] != word:
+            return None
+        return int(self.ids[pos])
+
+    def __contains__(self, word):
+        return self.index(word) != None
+
+    def tokenize(self, line, chr_level=False):
+        if chr_level:
+            return [cc.encode('utf-8') for cc in line.decode('utf-8').strip()]
+        return line.strip().split()
+
+    # words -> ids, UNK for unknown words and ids from n_words on
+    def lookup(self, words):
+        if self.id_table == None:
+            ids = self.ids
+            if self.n_words != None:
+                ids = numpy.where(ids < self.n_words, ids, 1)
+            self.id_table = IdTable(zip(self.table.tolist(), ids.tolist()))
+        return numpy.array(map(self.id_table.__getitem__, words), dtype='int64')
+
+    # lines -> ids of all their words, each line followed by <eos>, and the
+    # offsets of the lines: line ii is ids[offsets[ii]:offsets[ii+1]]
+    def encode_lines(self, lines, chr_level=False):
+        words = []
+        lengths = numpy.empty((len(lines),), dtype='int64')
+        for ii, line in enumerate(lines):
+            tokens = self.tokenize(line, chr_level=chr_level)
+            words += tokens
+            lengths[ii] = len(tokens)
+        ends = numpy.cumsum(lengths)
+        ids = numpy.insert(self.lookup(words), ends, 0)
+
+        offsets = numpy.zeros((len(lines) + 1,), dtype='int64')
+        offsets[1:] = ends + numpy.arange(1, len(lines) + 1)
+        return ids, offsets
+
+    # list of id sequences, each ending with <eos>
+    def encode_batch(self, lines, chr_level=False):
+        ids, offsets = self.encode_lines(lines, chr_level=chr_level)
+        return [ids[oo:ee] for oo, ee in zip(offsets[:-1], offsets[1:])]
+
+    def encode(self, line, chr_level=False):
+        return self.encode_batch([line], chr_level=chr_level)[0]
+
+    # id sequences -> lines, each up to its first <eos>, with one lookup for
+    # the whole batch; ids without a word are UNK
+    def decode_batch(self, seqs):
+        seqs = [numpy.asarray(seq, dtype='int64') for seq in seqs]
+        lengths = numpy.empty((len(seqs),), dtype='int64')
+        for ii, seq in enumerate(seqs):
+            eos = numpy.flatnonzero(seq == 0)
+            lengths[ii] = eos[0] if eos.shape[0] > 0 else seq.shape[0]
+        if lengths.sum() == 0:
+            return [''] * len(seqs)
+        ids = numpy.concatenate([seq[:ll] for seq, ll in zip(seqs, lengths)])
+        pos = self.rank[numpy.minimum(ids, self.rank.shape[0] - 1)]
+        pos[(ids >= self.rank.shape[0]) | (pos < 0)] = -1
+        words = ['UNK'] * ids.shape[0]
+        if self.table.shape[0] > 0:
+            words = self.table[numpy.maximum(pos, 0)].tolist()
+            for ii in numpy.flatnonzero(pos < 0):
+                words[ii] = 'UNK'
+
+        lines = []
+        start = 0
+        for ll in lengths:
+            lines.append(' '.join(words[start:start + ll]))
+            start += ll
+        return lines
+
+    def decode(self, seq):
+        return self.decode_batch([seq])[0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', type=str)
+    parser.add_argument('saveto', type=str)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    convert_pickle(args.source, args.saveto)